@@ -3,8 +3,6 @@ import os
 import openai
 from dotenv import load_dotenv
 import logging
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 load_dotenv()
@@ -20,33 +18,58 @@ try:
 except Exception as e:
     logging.error(f"Failed to configure OpenAI client for Ollama: {e}", exc_info=True)
 
-# --- 初始化 ChromaDB ---
-db = None
+# --- 嵌入模型與偵測器共用同一組 torch 執行緒設定 (見 runtime_profile.py) ---
+runtime_profile = None
 try:
-    CHROMA_DB_PATH = "./chroma_db"
-    embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2") # 可以保留常用模型
-    db = Chroma(persist_directory=CHROMA_DB_PATH, embedding_function=embedding_function)
-    logging.info("ChromaDB 連接成功.")
+    from runtime_profile import load_runtime_profile, apply_runtime_profile
+    runtime_profile = load_runtime_profile()
+    apply_runtime_profile(runtime_profile)
 except Exception as e:
-    logging.error(f"Failed to initialize ChromaDB: {e}", exc_info=True)
+    logging.error(f"套用執行設定失敗: {e}", exc_info=True)
+
+# --- 初始化檢索後端 ---
+# LAW_SEARCH_BACKEND=flat 使用 core/vector_index.py 的 NumPy 矩陣索引 (不需載入 chromadb)，
+# 載入失敗 (例如尚未執行 build) 時自動退回 ChromaDB。
+LAW_SEARCH_BACKEND = os.getenv('LAW_SEARCH_BACKEND', 'chroma')
+db = None
+flat_search = None
+if LAW_SEARCH_BACKEND == 'flat':
+    try:
+        from core.vector_index import FlatLawSearch, QueryEncoder
+        intra_op_threads = runtime_profile.get("intra_op_threads") if runtime_profile else None
+        flat_search = FlatLawSearch(encoder=QueryEncoder(intra_op_threads=intra_op_threads))
+    except Exception as e:
+        logging.error(f"輕量法規索引載入失敗，改用 ChromaDB: {e}", exc_info=True)
+
+if flat_search is None:
+    try:
+        from langchain_community.vectorstores import Chroma
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+        CHROMA_DB_PATH = "./chroma_db"
+        embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2") # 可以保留常用模型
+        db = Chroma(persist_directory=CHROMA_DB_PATH, embedding_function=embedding_function)
+        logging.info("ChromaDB 連接成功.")
+    except Exception as e:
+        logging.error(f"Failed to initialize ChromaDB: {e}", exc_info=True)
 
 def search_laws(query, k=5):
     """
-    在 ChromaDB 中搜尋與 query 相關的法規片段。
+    在法規向量索引 (ChromaDB 或輕量矩陣索引) 中搜尋與 query 相關的法規片段。
     """
-    if db is None:
+    if db is None and flat_search is None:
          logging.error("ChromaDB 未初始化，無法搜尋。")
          return ""
     try:
         logging.info(f"搜尋法規，關鍵字: {query}")
-        results = db.similarity_search(query, k=k)
+        if flat_search is not None:
+            results = flat_search.similarity_search(query, k=k)
+        else:
+            results = [(getattr(doc, 'page_content', ''), getattr(doc, 'metadata', {})) for doc in db.similarity_search(query, k=k)]
         context = ""
         count = 0
         processed_articles = set() # 保持過濾重複條文
 
-        for doc in results:
-             page_content = doc.page_content if hasattr(doc, 'page_content') else ''
-             metadata = doc.metadata if hasattr(doc, 'metadata') else {}
+        for page_content, metadata in results:
              article_num = metadata.get('article_number', f'Unknown_{count}')
 
              # 過濾空內容和重複 (保持)
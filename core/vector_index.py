@@ -0,0 +1,236 @@
+# core/vector_index.py
+# 輕量法規檢索：所有條文向量放在一個連續的 float16 / int8 NumPy 矩陣，top-k 只需一次矩陣乘法
+#
+# 使用方式 (在專案根目錄執行)：
+#   python -m core.vector_index build        # 從 ChromaDB 匯出向量成 .npz
+#   python -m core.vector_index export-onnx  # 匯出並量化 (int8) 查詢編碼器
+#   python -m core.vector_index parity       # 與 ChromaDB 的搜尋結果比對
+#   python -m core.vector_index bench        # 量測查詢延遲
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+CHROMA_DB_PATH = "./chroma_db"
+FLAT_INDEX_PATH = os.getenv('LAW_FLAT_INDEX_PATH', './chroma_db/law_index.npz')
+FLAT_INDEX_DTYPE = os.getenv('LAW_FLAT_INDEX_DTYPE', 'float16')          # float16 或 int8
+ONNX_MODEL_DIR = os.getenv('LAW_ONNX_MODEL_DIR', './chroma_db/onnx_encoder')
+
+PARITY_QUERIES = ["no_helmet", "未戴安全帽", "安全帽", "no_vest", "反光背心", "安全帶", "墜落", "高處作業",
+                  "開口防護", "施工架", "禁止進入", "個人防護具"]
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class FlatVectorIndex:
+    """
+    以單一矩陣保存所有條文向量 (已 L2 正規化)。
+    檔案中以 float16 或 int8 (加每列縮放係數) 儲存；載入時一次轉成 float32 的查詢矩陣
+    (縮放係數已乘入)，之後每次查詢只做一次 BLAS 矩陣乘法，不再逐次轉換型別。
+    記憶體中只保留 float32 矩陣，存檔時再轉回原本的儲存型別。
+    """
+
+    def __init__(self, vectors, documents, metadatas, scales=None):
+        vectors = np.asarray(vectors)
+        self.dtype = vectors.dtype
+        self.scales = None if scales is None else np.asarray(scales, dtype=np.float32)
+        self.documents = documents
+        self.metadatas = metadatas
+        matrix = vectors.astype(np.float32)
+        if self.scales is not None:
+            matrix *= self.scales[:, None]
+        self.matrix = np.ascontiguousarray(matrix)
+
+    def stored_vectors(self):
+        """回傳存檔用的 float16 / int8 矩陣 (float16 與 int8 乘回縮放係數後都可無損還原)。"""
+        if self.scales is not None:
+            return np.round(self.matrix / self.scales[:, None]).astype(self.dtype)
+        return self.matrix.astype(self.dtype)
+
+    @classmethod
+    def from_embeddings(cls, embeddings, documents, metadatas, dtype=FLAT_INDEX_DTYPE):
+        embeddings = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        if dtype == 'int8':
+            scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127.0
+            vectors = np.round(embeddings / scales[:, None]).astype(np.int8)
+            return cls(vectors, documents, metadatas, scales.astype(np.float32))
+        return cls(embeddings.astype(np.float16), documents, metadatas)
+
+    @classmethod
+    def load(cls, path=FLAT_INDEX_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            scales = data['scales'] if 'scales' in data.files else None
+            return cls(data['vectors'], json.loads(str(data['documents'])), json.loads(str(data['metadatas'])), scales)
+
+    def save(self, path=FLAT_INDEX_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        arrays = {
+            'vectors': self.stored_vectors(),
+            'documents': np.array(json.dumps(self.documents, ensure_ascii=False)),
+            'metadatas': np.array(json.dumps(self.metadatas, ensure_ascii=False)),
+        }
+        if self.scales is not None:
+            arrays['scales'] = self.scales
+        np.savez(path, **arrays)
+
+    def search(self, query_vector, k=5):
+        """回傳 [(分數, 文件, metadata)]，依分數由高到低。"""
+        query = np.asarray(query_vector, dtype=np.float32).ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        scores = self.matrix @ query
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.documents[i], self.metadatas[i]) for i in top]
+
+
+class QueryEncoder:
+    """
+    查詢編碼器：有匯出的 ONNX 模型時用 onnxruntime (int8 量化)，否則退回 sentence-transformers。
+    輸出與建立索引時相同的 MiniLM 句向量 (mean pooling + L2 正規化)。
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, onnx_dir=ONNX_MODEL_DIR, intra_op_threads=None):
+        self.session = None
+        self.tokenizer = None
+        self.model = None
+        onnx_path = os.path.join(onnx_dir, 'model.onnx')
+        if os.path.exists(onnx_path):
+            try:
+                import onnxruntime as ort
+                from transformers import AutoTokenizer
+                options = ort.SessionOptions()
+                if intra_op_threads:
+                    options.intra_op_num_threads = intra_op_threads
+                self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+                self.input_names = {i.name for i in self.session.get_inputs()}
+                self.tokenizer = AutoTokenizer.from_pretrained(onnx_dir)
+                logging.info(f"查詢編碼器使用 ONNX 模型: {onnx_path}")
+                return
+            except ImportError as e:
+                logging.warning(f"未安裝 onnxruntime，改用 sentence-transformers: {e}")
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        logging.info(f"查詢編碼器使用 sentence-transformers: {model_name}")
+
+    def encode(self, text):
+        if self.session is None:
+            return self.model.encode([text], normalize_embeddings=True)[0]
+        tokens = self.tokenizer([text], padding=True, truncation=True, max_length=256, return_tensors='np')
+        feeds = {name: tokens[name].astype(np.int64) for name in self.input_names if name in tokens}
+        hidden = self.session.run(None, feeds)[0]
+        mask = tokens['attention_mask'][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return _normalize_rows(pooled)[0]
+
+
+class FlatLawSearch:
+    """search_laws 使用的輕量後端：啟動時載入矩陣與編碼器，查詢時只做編碼與一次矩陣乘法。"""
+
+    def __init__(self, index_path=FLAT_INDEX_PATH, encoder=None):
+        self.index = FlatVectorIndex.load(index_path)
+        self.encoder = encoder or QueryEncoder()
+        logging.info(f"輕量法規索引載入完成: {len(self.index.documents)} 條，dtype={self.index.dtype}")
+
+    def similarity_search(self, query, k=5):
+        return [(document, metadata) for _, document, metadata in self.index.search(self.encoder.encode(query), k)]
+
+
+# --- 建立索引 / 匯出模型 / 比對工具 ---
+def _open_chroma():
+    from langchain_community.vectorstores import Chroma
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    return Chroma(persist_directory=CHROMA_DB_PATH, embedding_function=HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME))
+
+def build_index_from_chroma(out_path=FLAT_INDEX_PATH, dtype=FLAT_INDEX_DTYPE):
+    """把 ChromaDB 內已計算好的條文向量匯出成 FlatVectorIndex (不需重新計算 embedding)。"""
+    data = _open_chroma().get(include=['embeddings', 'documents', 'metadatas'])
+    index = FlatVectorIndex.from_embeddings(data['embeddings'], list(data['documents']),
+                                            [dict(m or {}) for m in data['metadatas']], dtype)
+    index.save(out_path)
+    logging.info(f"✅ 已匯出 {len(index.documents)} 條向量到 {out_path} (dtype={dtype})")
+    return index
+
+def export_onnx_encoder(model_name=EMBEDDING_MODEL_NAME, out_dir=ONNX_MODEL_DIR, quantize=True):
+    """將 MiniLM 的 transformer 匯出為 ONNX，並以動態量化轉成 int8 權重。"""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    repo_id = model_name if '/' in model_name else f"sentence-transformers/{model_name}"
+    tokenizer = AutoTokenizer.from_pretrained(repo_id)
+    model = AutoModel.from_pretrained(repo_id).eval()
+    os.makedirs(out_dir, exist_ok=True)
+    fp32_path = os.path.join(out_dir, 'model_fp32.onnx')
+    sample = tokenizer(["安全帽"], return_tensors='pt')
+    input_names = ['input_ids', 'attention_mask', 'token_type_ids']
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in input_names), fp32_path,
+                          input_names=input_names, output_names=['last_hidden_state'],
+                          dynamic_axes=dynamic_axes, opset_version=14)
+    final_path = os.path.join(out_dir, 'model.onnx')
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, final_path, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+    else:
+        os.replace(fp32_path, final_path)
+    tokenizer.save_pretrained(out_dir)
+    logging.info(f"✅ 查詢編碼器已匯出: {final_path} (quantized={quantize})")
+
+def parity_check(queries=PARITY_QUERIES, k=5):
+    """比較輕量索引與 ChromaDB 的 top-k 條號，回傳平均重疊率。"""
+    chroma = _open_chroma()
+    flat = FlatLawSearch()
+    overlaps = []
+    for query in queries:
+        expected = [doc.metadata.get('article_number') for doc in chroma.similarity_search(query, k=k)]
+        actual = [metadata.get('article_number') for _, metadata in flat.similarity_search(query, k=k)]
+        overlap = len(set(expected) & set(actual)) / max(1, len(expected))
+        overlaps.append(overlap)
+        flag = "✅" if expected[:1] == actual[:1] else "⚠️"
+        logging.info(f"{flag} {query}: overlap@{k}={overlap:.2f} chroma={expected} flat={actual}")
+    mean_overlap = float(np.mean(overlaps)) if overlaps else 0.0
+    logging.info(f"平均 overlap@{k}: {mean_overlap:.3f}")
+    return mean_overlap
+
+def benchmark(queries=PARITY_QUERIES, rounds=50, k=5):
+    flat = FlatLawSearch()
+    vectors = [flat.encoder.encode(q) for q in queries]
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for q in queries:
+            flat.encoder.encode(q)
+    encode_ms = (time.perf_counter() - t0) * 1000 / (rounds * len(queries))
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for v in vectors:
+            flat.index.search(v, k)
+    search_ms = (time.perf_counter() - t0) * 1000 / (rounds * len(vectors))
+    logging.info(f"查詢編碼 {encode_ms:.3f} ms/次，矩陣檢索 {search_ms:.4f} ms/次")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else 'build'
+    if command == 'build':
+        build_index_from_chroma()
+    elif command == 'export-onnx':
+        export_onnx_encoder()
+    elif command == 'parity':
+        sys.exit(0 if parity_check() >= 0.8 else 1)
+    elif command == 'bench':
+        benchmark()
+    else:
+        print("用法: python -m core.vector_index [build|export-onnx|parity|bench]")
+        sys.exit(2)
@@ -0,0 +1,176 @@
+# event_analyzer.py
+# 中文自然語言時間範圍解析 (今天、昨天、本週、上個月、最近3天、4/1到4/10 ...)
+# 規則全部預先編譯，並以 LRU 快取正規化後的句子；回傳 [start, end) 的 datetime
+import calendar
+import re
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+# --- 正規化：全形數字、簡體常見字、查詢用語 ---
+_NORMALIZE_TABLE = str.maketrans({
+    **{chr(0xFF10 + i): str(i) for i in range(10)},
+    '／': '/', '－': '-', '～': '~', '．': '.',
+    '周': '週', '这': '這', '个': '個', '礼': '禮', '过': '過', '号': '號', '后': '後',
+})
+_FILLER_PATTERN = re.compile(r'\s+|查詢|查询|查看|列出|違規|违规|紀錄|记录|統計|统计|事件|的|一下|請|幫我')
+
+_CN_DIGITS = {'零': 0, '一': 1, '二': 2, '兩': 2, '两': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_NUMBER = r'(\d+|[零一二兩两三四五六七八九十]+)'
+_DATE = r'(?<!\d)(?:(\d{4})[/\-.年])?(\d{1,2})[/\-.月](\d{1,2})[日號]?'
+
+_RANGE_PATTERN = re.compile(_DATE + r'(?:到|至|~|—|-)(?:(\d{4})[/\-.年])?(?:(\d{1,2})[/\-.月])?(\d{1,2})[日號]?')
+_LAST_N_PATTERN = re.compile(r'(?:最近|近|過去|前)' + _NUMBER + r'(?:個)?(天|日|週|星期|禮拜|月|小時)')
+_SINGLE_DATE_PATTERN = re.compile(_DATE)
+
+# 關鍵字 -> (單位, 偏移)；長的詞放前面 (大前天 要先於 前天)
+_KEYWORDS = {
+    '今天': ('day', 0), '今日': ('day', 0), '昨天': ('day', -1), '昨日': ('day', -1),
+    '前天': ('day', -2), '大前天': ('day', -3),
+    '本週': ('week', 0), '這週': ('week', 0), '本星期': ('week', 0), '這星期': ('week', 0),
+    '這禮拜': ('week', 0), '本禮拜': ('week', 0),
+    '上週': ('week', -1), '上星期': ('week', -1), '上禮拜': ('week', -1), '上個禮拜': ('week', -1),
+    '上上週': ('week', -2), '上上星期': ('week', -2), '上上禮拜': ('week', -2), '上上個禮拜': ('week', -2),
+    '本月': ('month', 0), '這個月': ('month', 0), '這月': ('month', 0), '上個月': ('month', -1), '上月': ('month', -1),
+    '上上個月': ('month', -2), '上上月': ('month', -2),
+    '今年': ('year', 0), '去年': ('year', -1),
+}
+_KEYWORD_PATTERN = re.compile('|'.join(sorted(map(re.escape, _KEYWORDS), key=len, reverse=True)))
+
+
+def _cn_to_int(token):
+    """支援阿拉伯數字與 99 以內的中文數字 (三、十、十五、二十三)。"""
+    if token.isdigit():
+        return int(token)
+    if '十' in token:
+        tens, _, ones = token.partition('十')
+        return (_CN_DIGITS.get(tens, 1) if tens else 1) * 10 + (_CN_DIGITS.get(ones, 0) if ones else 0)
+    return _CN_DIGITS.get(token)
+
+def normalize(text):
+    return _FILLER_PATTERN.sub('', text.translate(_NORMALIZE_TABLE))
+
+
+@lru_cache(maxsize=1024)
+def _parse_phrase(phrase):
+    """
+    將正規化後的句子轉成與日期無關的描述 (spec)，結果可以安全快取；
+    實際的 datetime 由 _resolve() 依當下時間計算。
+    """
+    match = _RANGE_PATTERN.search(phrase)
+    if match:
+        y1, m1, d1, y2, m2, d2 = match.groups()
+        return ('range', (y1 and int(y1), int(m1), int(d1)), (y2 and int(y2), int(m2 or m1), int(d2)))
+
+    match = _LAST_N_PATTERN.search(phrase)
+    if match:
+        n = _cn_to_int(match.group(1))
+        unit = {'日': '天', '星期': '週', '禮拜': '週'}.get(match.group(2), match.group(2))
+        if n:
+            return ('last', unit, n)
+
+    match = _KEYWORD_PATTERN.search(phrase)
+    if match:
+        unit, offset = _KEYWORDS[match.group(0)]
+        return (unit, offset)
+
+    match = _SINGLE_DATE_PATTERN.search(phrase)
+    if match:
+        y, m, d = match.groups()
+        return ('date', (y and int(y), int(m), int(d)))
+    return None
+
+
+def _month_start(year, month, offset):
+    index = year * 12 + (month - 1) + offset
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def _months_before(day, n):
+    """day 往前 n 個月的同一天；該月沒有這一天時取月底 (例如 3/31 往前一個月為 2/28)。"""
+    index = day.year * 12 + (day.month - 1) - n
+    year, month = index // 12, index % 12 + 1
+    return datetime(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+def _past_date(year, month, day, today):
+    """未指定年份的日期：查詢的是過去的紀錄，今年的這一天還沒到就取去年。"""
+    if year:
+        return datetime(year, month, day)
+    date = datetime(today.year, month, day)
+    return date if date <= today else datetime(today.year - 1, month, day)
+
+def _resolve(spec, now):
+    today = datetime(now.year, now.month, now.day)
+    kind = spec[0]
+    if kind == 'day':
+        start = today + timedelta(days=spec[1])
+        return start, start + timedelta(days=1)
+    if kind == 'week':
+        start = today - timedelta(days=today.weekday()) + timedelta(weeks=spec[1])
+        return start, start + timedelta(weeks=1)
+    if kind == 'month':
+        return _month_start(now.year, now.month, spec[1]), _month_start(now.year, now.month, spec[1] + 1)
+    if kind == 'year':
+        return datetime(now.year + spec[1], 1, 1), datetime(now.year + spec[1] + 1, 1, 1)
+    if kind == 'last':
+        _, unit, n = spec
+        if unit == '小時':
+            return now - timedelta(hours=n), now
+        tomorrow = today + timedelta(days=1)
+        if unit == '天':
+            return tomorrow - timedelta(days=n), tomorrow
+        if unit == '週':
+            return tomorrow - timedelta(weeks=n), tomorrow
+        return _months_before(tomorrow, n), tomorrow  # 月：與天 / 週相同，往回推 n 個月
+    if kind == 'date':
+        start = _past_date(*spec[1], today)
+        return start, start + timedelta(days=1)
+    if kind == 'range':
+        (y1, m1, d1), (y2, m2, d2) = spec[1], spec[2]
+        start = _past_date(y1, m1, d1, today)
+        end = datetime(y2 or start.year, m2, d2)
+        if end < start and not y2 and datetime(start.year + 1, m2, d2) <= today:
+            end = datetime(start.year + 1, m2, d2)  # 跨年，例如 12/25到1/5
+        if end < start:
+            start, end = end, start  # 順序顛倒，例如 4/10到4/1
+        return start, end + timedelta(days=1)
+    return None, None
+
+
+def parse_natural_language_time(text, now=None):
+    """
+    解析文字中的時間範圍，回傳 (start, end)，end 不包含在範圍內；
+    無法解析時回傳 (None, None)。
+    """
+    if not text:
+        return None, None
+    spec = _parse_phrase(normalize(text))
+    if spec is None:
+        return None, None
+    try:
+        return _resolve(spec, now or datetime.now())
+    except (ValueError, OverflowError):
+        # 例如 2/30 這類不存在的日期，或「最近99999999天」超出 datetime 範圍
+        return None, None
+
+
+# --- 微基準測試: python event_analyzer.py ---
+if __name__ == "__main__":
+    samples = ["查詢今天違規", "查詢昨天的違規紀錄", "查詢本週違規統計", "查看上個月違規", "查詢最近3天違規",
+               "查詢近七天違規", "查詢4/1到4/10違規", "查詢2024年3月5日違規", "查詢过去两周违规", "查詢最近12小時違規"]
+    fixed_now = datetime(2025, 4, 16, 15, 30)
+    for sample in samples:
+        start, end = parse_natural_language_time(sample, fixed_now)
+        print(f"{sample:<16} -> {start} ~ {end}")
+
+    rounds = 20000
+    _parse_phrase.cache_clear()
+    t0 = time.perf_counter()
+    for sample in samples:
+        _parse_phrase.cache_clear()
+        parse_natural_language_time(sample)
+    cold = (time.perf_counter() - t0) / len(samples)
+    t0 = time.perf_counter()
+    for i in range(rounds):
+        parse_natural_language_time(samples[i % len(samples)])
+    warm = (time.perf_counter() - t0) / rounds
+    print(f"\n未快取: {cold * 1e6:.1f} µs/次，已快取: {warm * 1e6:.1f} µs/次 ({_parse_phrase.cache_info()})")
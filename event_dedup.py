@@ -0,0 +1,107 @@
+# event_dedup.py
+# Webhook 冪等處理：以 webhookEventId / message.id 去除 LINE 重送的事件
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+EVENT_DEDUP_BACKEND = os.getenv('EVENT_DEDUP_BACKEND', 'memory')   # memory 或 sqlite
+EVENT_DEDUP_PATH = os.getenv('EVENT_DEDUP_PATH', './data/event_dedup.sqlite3')
+EVENT_DEDUP_TTL = float(os.getenv('EVENT_DEDUP_TTL', 24 * 3600))      # 秒
+EVENT_DEDUP_MAX_ENTRIES = int(os.getenv('EVENT_DEDUP_MAX_ENTRIES', 100000))
+
+
+def event_key(event):
+    """取得事件的冪等鍵；優先使用 webhookEventId，舊版 SDK 沒有時改用 message.id。"""
+    webhook_event_id = getattr(event, 'webhook_event_id', None)
+    if webhook_event_id:
+        return f"evt:{webhook_event_id}"
+    message = getattr(event, 'message', None)
+    if message is not None and getattr(message, 'id', None):
+        return f"msg:{message.id}"
+    return None
+
+
+class MemoryDedupStore:
+    """有容量上限的 TTL 記憶體表；claim() 第一次看到某鍵時回傳 True。"""
+
+    def __init__(self, ttl=EVENT_DEDUP_TTL, max_entries=EVENT_DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> 到期時間，依插入順序 (也就是到期順序)
+        self.lock = threading.Lock()
+
+    def claim(self, key):
+        now = time.monotonic()
+        with self.lock:
+            expires_at = self.entries.get(key)
+            if expires_at is not None and expires_at > now:
+                return False
+            self.entries.pop(key, None)
+            self.entries[key] = now + self.ttl
+            # 先清掉過期的，再依容量淘汰最舊的
+            while self.entries:
+                oldest_key, oldest_expiry = next(iter(self.entries.items()))
+                if oldest_expiry > now and len(self.entries) <= self.max_entries:
+                    break
+                self.entries.popitem(last=False)
+            return True
+
+
+class SQLiteDedupStore:
+    """
+    以 SQLite 持久化的去重表，重啟後仍能辨識重送事件。
+    前面疊一層 MemoryDedupStore，熱門的重送在記憶體就會被擋下。
+    """
+
+    def __init__(self, path=EVENT_DEDUP_PATH, ttl=EVENT_DEDUP_TTL, max_entries=EVENT_DEDUP_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory = MemoryDedupStore(ttl, max_entries)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS webhook_events (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_events_expiry ON webhook_events (expires_at)")
+        self.conn.commit()
+        self.claims_since_purge = 0
+
+    def claim(self, key):
+        if not self.memory.claim(key):
+            return False
+        now = time.time()
+        with self.lock:
+            # 已過期的舊紀錄可以被覆寫；未過期的則代表重送
+            cursor = self.conn.execute(
+                "INSERT INTO webhook_events (key, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at WHERE webhook_events.expires_at <= ?",
+                (key, now + self.ttl, now)
+            )
+            claimed = cursor.rowcount == 1
+            self.claims_since_purge += 1
+            if self.claims_since_purge >= 1000:
+                self._purge(now)
+            self.conn.commit()
+        return claimed
+
+    def _purge(self, now):
+        self.claims_since_purge = 0
+        self.conn.execute("DELETE FROM webhook_events WHERE expires_at <= ?", (now,))
+        self.conn.execute(
+            "DELETE FROM webhook_events WHERE key IN ("
+            "SELECT key FROM webhook_events ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+
+def create_dedup_store():
+    if EVENT_DEDUP_BACKEND == 'sqlite':
+        logging.info(f"Webhook 去重使用 SQLite: {EVENT_DEDUP_PATH}")
+        return SQLiteDedupStore()
+    return MemoryDedupStore()
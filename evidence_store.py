@@ -0,0 +1,157 @@
+# evidence_store.py
+# 違規證據圖片儲存：以 SHA-256 內容定址去重、重新壓縮、一次產生縮圖，並依時間與容量定期清理
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import cv2
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+EVIDENCE_DIR = os.getenv('EVIDENCE_DIR', './evidence')
+EVIDENCE_JPEG_QUALITY = int(os.getenv('EVIDENCE_JPEG_QUALITY', 85))
+EVIDENCE_MAX_SIDE = int(os.getenv('EVIDENCE_MAX_SIDE', 1920))              # 原圖最長邊上限 (px)
+THUMBNAIL_SIZE = int(os.getenv('THUMBNAIL_SIZE', 240))                    # 縮圖最長邊 (px)
+EVIDENCE_RETENTION_DAYS = float(os.getenv('EVIDENCE_RETENTION_DAYS', 90))
+EVIDENCE_MAX_BYTES = int(os.getenv('EVIDENCE_MAX_MB', 2048)) * 1024 * 1024
+EVIDENCE_COMPACT_INTERVAL = float(os.getenv('EVIDENCE_COMPACT_INTERVAL', 3600))  # 秒
+
+_KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+def is_evidence_key(value):
+    return bool(value) and bool(_KEY_PATTERN.match(str(value)))
+
+
+def _resize_to(frame, max_side):
+    scale = max_side / max(frame.shape[:2])
+    if scale < 1:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return frame
+
+def _atomic_write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class EvidenceStore:
+    """
+    證據圖片以原始內容的 SHA-256 作為 key，路徑為 objects/ab/<key>.jpg 與 thumbs/ab/<key>.jpg。
+    相同圖片只會存一份；違規紀錄的 image_path 欄位保存 key。
+    """
+
+    def __init__(self, root=EVIDENCE_DIR, quality=EVIDENCE_JPEG_QUALITY, max_side=EVIDENCE_MAX_SIDE,
+                 thumbnail_size=THUMBNAIL_SIZE, retention_days=EVIDENCE_RETENTION_DAYS, max_bytes=EVIDENCE_MAX_BYTES):
+        self.root = root
+        self.quality = quality
+        self.max_side = max_side
+        self.thumbnail_size = thumbnail_size
+        self.retention_seconds = retention_days * 86400
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._compactor = None
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'thumbs'), exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, 'objects', key[:2], f"{key}.jpg")
+
+    def thumbnail_path(self, key):
+        return os.path.join(self.root, 'thumbs', key[:2], f"{key}.jpg")
+
+    def put(self, image_path):
+        """存入圖片並回傳 key；已存在時只更新時間戳記 (延長保存期限)。"""
+        with open(image_path, 'rb') as f:
+            raw = f.read()
+        key = hashlib.sha256(raw).hexdigest()
+        object_path = self.path(key)
+        with self.lock:
+            if os.path.exists(object_path):
+                os.utime(object_path)
+                return key
+
+        frame = cv2.imread(image_path)
+        if frame is None:
+            raise ValueError(f"無法讀取證據圖片: {image_path}")
+        ok, encoded = cv2.imencode('.jpg', _resize_to(frame, self.max_side), [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        ok_thumb, thumb = cv2.imencode('.jpg', _resize_to(frame, self.thumbnail_size), [cv2.IMWRITE_JPEG_QUALITY, 80])
+        if not ok or not ok_thumb:
+            raise ValueError(f"證據圖片編碼失敗: {image_path}")
+        with self.lock:
+            # 縮圖先寫，object 存在即代表縮圖也存在
+            _atomic_write(self.thumbnail_path(key), thumb.tobytes())
+            _atomic_write(object_path, encoded.tobytes())
+        logging.info(f"證據已存入 {key[:12]}… ({len(raw) / 1024:.0f} KB -> {len(encoded) / 1024:.0f} KB)")
+        return key
+
+    def exists(self, key):
+        return is_evidence_key(key) and os.path.exists(self.path(key))
+
+    # --- 保存期限與容量清理 ---
+    def compact(self):
+        """刪除超過保存天數的證據，總容量仍超標時再從最舊的開始刪；回傳刪除數量。"""
+        entries = []
+        objects_root = os.path.join(self.root, 'objects')
+        for dirpath, _, filenames in os.walk(objects_root):
+            for name in filenames:
+                if not name.endswith('.jpg'):
+                    continue
+                full_path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(full_path)
+                except FileNotFoundError:
+                    continue
+                thumb_path = self.thumbnail_path(name[:-4])
+                thumb_size = os.path.getsize(thumb_path) if os.path.exists(thumb_path) else 0
+                entries.append((stat.st_mtime, name[:-4], stat.st_size + thumb_size))
+
+        entries.sort()
+        total_bytes = sum(size for _, _, size in entries)
+        cutoff = time.time() - self.retention_seconds
+        removed = 0
+        for mtime, key, size in entries:
+            if mtime >= cutoff and total_bytes <= self.max_bytes:
+                break
+            with self.lock:
+                for path in (self.path(key), self.thumbnail_path(key)):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            total_bytes -= size
+            removed += 1
+        if removed:
+            logging.info(f"證據清理完成：刪除 {removed} 筆，剩餘 {total_bytes / 1024 / 1024:.1f} MB")
+        return removed
+
+    def start_compactor(self, interval=EVIDENCE_COMPACT_INTERVAL):
+        if self._compactor and self._compactor.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.compact()
+                except Exception as e:
+                    logging.error(f"證據清理時發生錯誤: {e}", exc_info=True)
+                self._stop.wait(interval)
+
+        self._compactor = threading.Thread(target=run, name="evidence-compactor", daemon=True)
+        self._compactor.start()
+
+    def stop_compactor(self):
+        self._stop.set()
@@ -0,0 +1,304 @@
+# line_messenger.py
+# 對外 LINE 訊息發送：持久化佇列 + Token Bucket 限速 + multicast 批次 + 指數退避重試
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+LINE_API_ENDPOINT = os.getenv('LINE_API_ENDPOINT', 'https://api.line.me')
+LINE_OUTBOX_PATH = os.getenv('LINE_OUTBOX_PATH', './data/line_outbox.sqlite3')
+
+# LINE Messaging API 的速率上限 (每秒請求數)，可用環境變數調低
+RATE_LIMITS = {
+    "reply": float(os.getenv('LINE_REPLY_RATE', 2000)),
+    "push": float(os.getenv('LINE_PUSH_RATE', 2000)),
+    "multicast": float(os.getenv('LINE_MULTICAST_RATE', 200)),
+}
+MAX_MESSAGES_PER_REQUEST = 5     # 單一請求最多 5 則訊息
+MULTICAST_MAX_RECIPIENTS = 500   # multicast 單次最多 500 位收件者
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def text_message(text):
+    return {"type": "text", "text": text}
+
+def image_message(original_url, preview_url=None):
+    return {"type": "image", "originalContentUrl": original_url, "previewImageUrl": preview_url or original_url}
+
+
+class TokenBucket:
+    """執行緒安全的 Token Bucket；acquire() 會阻塞直到取得足夠 token。"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SendQueue:
+    """SQLite 持久化的待發送佇列，重啟後未送出的 push / multicast 仍會繼續送。"""
+
+    def __init__(self, path=LINE_OUTBOX_PATH):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS outbox (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   endpoint TEXT NOT NULL,
+                   recipients TEXT NOT NULL,
+                   messages TEXT NOT NULL,
+                   retry_key TEXT,
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   next_attempt_at REAL NOT NULL,
+                   status TEXT NOT NULL DEFAULT 'pending',
+                   last_error TEXT,
+                   created_at REAL NOT NULL)"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+        self.conn.commit()
+
+    def put(self, endpoint, recipients, messages):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO outbox (endpoint, recipients, messages, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (endpoint, json.dumps(recipients), json.dumps(messages, ensure_ascii=False), now, now)
+            )
+            self.conn.commit()
+
+    def due(self, limit=100):
+        """
+        回傳到期的項目 (最多約 limit 筆)。已指定 retry key 的批次一定整批回傳：
+        若只送出其中一部分，剩下的項目之後以同一個 key 重送會得到 409 而被誤當成已送達。
+        """
+        columns = "SELECT id, endpoint, recipients, messages, retry_key, attempts FROM outbox "
+        with self.lock:
+            rows = self.conn.execute(
+                columns + "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+            retry_keys = sorted({r[4] for r in rows if r[4]})
+            if retry_keys:
+                seen = {r[0] for r in rows}
+                siblings = self.conn.execute(
+                    columns + f"WHERE status = 'pending' AND retry_key IN ({','.join('?' * len(retry_keys))})",
+                    retry_keys
+                ).fetchall()
+                rows = sorted(rows + [r for r in siblings if r[0] not in seen])
+        return [{"id": r[0], "endpoint": r[1], "recipients": json.loads(r[2]), "messages": json.loads(r[3]),
+                 "retry_key": r[4], "attempts": r[5]} for r in rows]
+
+    def assign_retry_key(self, ids, retry_key):
+        # 同一批次固定使用同一個 X-Line-Retry-Key，重試時才不會重複送達
+        with self.lock:
+            self.conn.executemany("UPDATE outbox SET retry_key = ? WHERE id = ?", [(retry_key, i) for i in ids])
+            self.conn.commit()
+
+    def done(self, ids):
+        with self.lock:
+            self.conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+            self.conn.commit()
+
+    def reschedule(self, ids, attempts, next_attempt_at, error):
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                [(attempts, next_attempt_at, error, i) for i in ids]
+            )
+            self.conn.commit()
+
+    def mark_dead(self, ids, error):
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE outbox SET status = 'dead', last_error = ? WHERE id = ?", [(error, i) for i in ids]
+            )
+            self.conn.commit()
+
+    def pending_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+
+
+class LineMessenger:
+    """
+    LINE 訊息發送器。
+    reply 會同步送出 (reply token 約一分鐘內失效，不適合排隊)；push / multicast 進入持久化佇列，
+    由背景執行緒依速率限制批次送出，失敗時以指數退避重試。
+    """
+
+    def __init__(self, channel_access_token, endpoint=LINE_API_ENDPOINT, queue=None,
+                 max_attempts=6, backoff_base=1.0, backoff_max=300.0, poll_interval=0.5):
+        self.endpoint = endpoint.rstrip('/')
+        self.queue = queue if queue is not None else SendQueue()
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.buckets = {name: TokenBucket(rate) for name, rate in RATE_LIMITS.items()}
+
+        # 共用 Session 以重複使用 HTTP keep-alive 連線
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {channel_access_token}',
+            'Content-Type': 'application/json',
+        })
+
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    # --- 對外介面 ---
+    def reply(self, reply_token, messages, max_attempts=3):
+        """同步回覆；成功回傳 True。重試次數與退避時間較短，以免超過 reply token 期限。"""
+        payload = {"replyToken": reply_token, "messages": messages[:MAX_MESSAGES_PER_REQUEST]}
+        for attempt in range(max_attempts):
+            self.buckets["reply"].acquire()
+            ok, retryable, retry_after, error = self._post("reply", payload)
+            if ok:
+                return True
+            if not retryable or attempt == max_attempts - 1:
+                logging.error(f"LINE 回覆失敗 (第 {attempt + 1} 次): {error}")
+                return False
+            time.sleep(min(retry_after or 0.5 * 2 ** attempt, 5.0))
+        return False
+
+    def push(self, to, messages):
+        """排入單一使用者的 push 訊息。"""
+        for i in range(0, len(messages), MAX_MESSAGES_PER_REQUEST):
+            self.queue.put("push", to, messages[i:i + MAX_MESSAGES_PER_REQUEST])
+        self._wakeup.set()
+
+    def multicast(self, user_ids, messages):
+        """排入 multicast 訊息；收件者依 500 人切批。"""
+        user_ids = sorted(set(user_ids))
+        if not user_ids:
+            return
+        for i in range(0, len(user_ids), MULTICAST_MAX_RECIPIENTS):
+            chunk = user_ids[i:i + MULTICAST_MAX_RECIPIENTS]
+            for j in range(0, len(messages), MAX_MESSAGES_PER_REQUEST):
+                self.queue.put("multicast", chunk, messages[j:j + MAX_MESSAGES_PER_REQUEST])
+        self._wakeup.set()
+
+    def start(self):
+        if self._worker and self._worker.is_alive():
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, name="line-messenger", daemon=True)
+        self._worker.start()
+        logging.info(f"LINE 發送佇列啟動，待發送 {self.queue.pending_count()} 筆。")
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._wakeup.set()
+        if self._worker:
+            self._worker.join(timeout)
+
+    # --- 背景發送 ---
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sent = self.flush()
+            except Exception as e:
+                logging.error(f"LINE 發送佇列處理時發生錯誤: {e}", exc_info=True)
+                sent = 0
+            if not sent:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def flush(self):
+        """送出所有到期的佇列項目，回傳發出的請求數。"""
+        batches = self._build_batches(self.queue.due())
+        for batch in batches:
+            self.buckets[batch["endpoint"]].acquire()
+            payload = {"to": batch["recipients"], "messages": batch["messages"]}
+            ok, retryable, retry_after, error = self._post(batch["endpoint"], payload, batch["retry_key"])
+            if ok:
+                self.queue.done(batch["ids"])
+                continue
+            attempts = batch["attempts"] + 1
+            if not retryable or attempts >= self.max_attempts:
+                logging.error(f"LINE {batch['endpoint']} 發送放棄 (嘗試 {attempts} 次): {error}")
+                self.queue.mark_dead(batch["ids"], error)
+                continue
+            delay = retry_after or min(self.backoff_max, self.backoff_base * 2 ** batch["attempts"]) * (0.5 + random.random() / 2)
+            logging.warning(f"LINE {batch['endpoint']} 發送失敗，{delay:.1f} 秒後重試: {error}")
+            self.queue.reschedule(batch["ids"], attempts, time.time() + delay, error)
+        return len(batches)
+
+    def _build_batches(self, rows):
+        """
+        將佇列項目組成請求：已嘗試過的項目依原 retry key 重組 (確保重試內容一致)，
+        新項目則把相同收件者的訊息合併成最多 5 則一批，例如短時間內多筆主管警示。
+        """
+        batches = {}
+        fresh = {}
+        new_keys = []
+        for row in rows:
+            if row["retry_key"]:
+                batch = batches.setdefault(row["retry_key"], {
+                    "endpoint": row["endpoint"], "recipients": row["recipients"], "messages": [],
+                    "retry_key": row["retry_key"], "attempts": row["attempts"], "ids": []})
+                batch["messages"].extend(row["messages"])
+                batch["ids"].append(row["id"])
+            else:
+                fresh.setdefault((row["endpoint"], json.dumps(row["recipients"])), []).append(row)
+
+        for group in fresh.values():
+            current = None
+            for row in group:
+                if current is None or len(current["messages"]) + len(row["messages"]) > MAX_MESSAGES_PER_REQUEST:
+                    current = {"endpoint": row["endpoint"], "recipients": row["recipients"], "messages": [],
+                               "retry_key": str(uuid.uuid4()), "attempts": 0, "ids": []}
+                    batches[current["retry_key"]] = current
+                    new_keys.append(current["retry_key"])
+                current["messages"].extend(row["messages"])
+                current["ids"].append(row["id"])
+        for retry_key in new_keys:
+            self.queue.assign_retry_key(batches[retry_key]["ids"], retry_key)
+        return list(batches.values())
+
+    def _post(self, endpoint, payload, retry_key=None):
+        """回傳 (成功, 可重試, Retry-After 秒數, 錯誤訊息)。"""
+        headers = {'X-Line-Retry-Key': retry_key} if retry_key else None
+        try:
+            resp = self.session.post(f"{self.endpoint}/v2/bot/message/{endpoint}", json=payload,
+                                     headers=headers, timeout=(3.05, 10))
+        except requests.RequestException as e:
+            return False, True, None, str(e)
+        if resp.status_code == 200:
+            return True, False, None, None
+        if resp.status_code == 409 and retry_key:
+            # 相同 retry key 已被 LINE 接受過，視為成功
+            return True, False, None, None
+        retry_after = resp.headers.get('Retry-After')
+        retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+        return False, resp.status_code in RETRYABLE_STATUS, retry_after, f"{resp.status_code} {resp.text[:200]}"
@@ -1,16 +1,22 @@
 # linebot_handler.py (精簡版)
-from flask import Flask, request, abort
+from flask import Flask, request, abort, send_from_directory, send_file, jsonify
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError, LineBotApiError
-from linebot.models import MessageEvent, TextMessage, ImageMessage, TextSendMessage
+from linebot.models import MessageEvent, TextMessage, ImageMessage
 from yolo_detector import SafetyViolationDetector
+from event_dedup import create_dedup_store, event_key
+from line_messenger import LineMessenger, text_message, image_message
+from violation_report import summarize, format_report_text, render_trend_chart, REPORT_DIR
+from evidence_store import EvidenceStore
 from core.search_laws import search_laws, generate_response
 import os
 from event_analyzer import parse_natural_language_time # 保留時間解析
-from datetime import datetime
+from datetime import datetime, timedelta
 import mysql.connector
+from mysql.connector import errorcode
 from dotenv import load_dotenv
 import logging
+import threading
 
 load_dotenv()
 
@@ -21,6 +27,7 @@ app = Flask(__name__)
 # --- Line Bot 初始化 (保持基本檢查) ---
 line_bot_api = None
 handler = None
+messenger = None
 try:
     line_channel_access_token = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
     line_channel_secret = os.getenv('LINE_CHANNEL_SECRET')
@@ -29,6 +36,9 @@ try:
         exit()
     line_bot_api = LineBotApi(line_channel_access_token)
     handler = WebhookHandler(line_channel_secret)
+    # 對外發送 (reply / push / multicast) 統一走 messenger，line_bot_api 只用來下載圖片
+    messenger = LineMessenger(line_channel_access_token)
+    messenger.start()
     logging.info("Line Bot 初始化成功。")
 except Exception as e:
     logging.error(f"Line Bot 初始化失敗: {e}")
@@ -56,20 +66,154 @@ db_config = {
 }
 logging.info(f"資料庫配置: {db_config['host']}:{db_config['port']}/{db_config['database']}")
 
+# --- 違規代碼對應的法規查詢關鍵字 (向量檢索用中文描述，英文代碼檢索效果差)，未列出的代碼直接以代碼查詢 ---
+VIOLATION_LAW_QUERIES = {
+    "no_helmet": "未戴安全帽",
+    "no_vest": "未穿著反光背心",
+    "no_harness": "高處作業未使用安全帶",
+}
+
+def search_laws_for_violations(violation_types):
+    """每種違規各自查詢法規後合併；同時有多種違規時每種少取幾條，避免 prompt 過長。"""
+    k = 5 if len(violation_types) == 1 else 3
+    contexts = []
+    for single_type in violation_types:
+        query = VIOLATION_LAW_QUERIES.get(single_type, single_type)
+        context = search_laws(query, k=k)
+        if context and context.strip():
+            contexts.append(f"【{query}】{context}" if len(violation_types) > 1 else context)
+    return "\n".join(contexts)
+
+# --- 工地主管警示名單 (逗號分隔的 LINE userId) ---
+supervisor_ids = [uid.strip() for uid in os.getenv('LINE_SUPERVISOR_IDS', '').split(',') if uid.strip()]
+
+# --- 報表圖片對外網址 (LINE 圖片訊息需要 HTTPS，例如 ngrok 網址)，未設定時報表只回文字 ---
+public_base_url = os.getenv('PUBLIC_BASE_URL', '').rstrip('/')
+
+# --- Webhook 事件去重 (LINE 在 /callback 逾時會重送同一事件) ---
+dedup_store = create_dedup_store()
+
+def is_duplicate_event(event):
+    """在下載、推論或寫入資料庫之前擋下重送事件。"""
+    key = event_key(event)
+    if key and not dedup_store.claim(key):
+        logging.info(f"略過重送的 Webhook 事件: {key}")
+        return True
+    return False
+
+# --- 證據圖片儲存 (內容定址 + 背景清理) ---
+evidence_store = None
+try:
+    evidence_store = EvidenceStore()
+    evidence_store.start_compactor()
+    logging.info(f"證據儲存位置: {evidence_store.root}")
+except Exception as e:
+    logging.error(f"初始化證據儲存失敗: {e}", exc_info=True)
+
 
 # --- 資料庫操作函數 (精簡 Log) ---
-def save_violation_record(violation_type, image_path):
+# 啟動時 MySQL 可能尚未就緒 (depends_on 不會等資料庫可連線)，彙總表改為在寫入時補建。
+# summary_generation 在每次建表回填後遞增；紀錄寫入期間若發生回填就不再遞增彙總，避免重複計算。
+summary_table_ready = False
+summary_generation = 0
+summary_table_lock = threading.Lock()
+
+def ensure_summary_table():
+    """建立每日彙總表；第一次建立時從既有 violations 回填。呼叫端需持有 summary_table_lock。"""
+    global summary_table_ready, summary_generation
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(**db_config)
+        cursor = conn.cursor()
+        cursor.execute("SHOW TABLES LIKE 'violation_daily_summary'")
+        exists = cursor.fetchone() is not None
+        if exists:
+            summary_table_ready = True
+            return
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS violation_daily_summary (
+            day DATE NOT NULL, violation_type VARCHAR(64) NOT NULL, count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, violation_type)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """)
+        cursor.execute("""
+        INSERT INTO violation_daily_summary (day, violation_type, count)
+        SELECT DATE(timestamp), violation_type, COUNT(*) FROM violations GROUP BY DATE(timestamp), violation_type
+        """)
+        conn.commit()
+        summary_table_ready = True
+        summary_generation += 1
+        logging.info(f"已建立 violation_daily_summary 並回填 {cursor.rowcount} 筆彙總。")
+    except mysql.connector.Error as err:
+        logging.error(f"資料庫錯誤 (建立每日彙總表): {err}")
+    except Exception as e:
+        logging.error(f"建立每日彙總表時發生未知錯誤: {e}", exc_info=True)
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+
+with summary_table_lock:
+    ensure_summary_table()
+
+def prepare_daily_summary():
+    """
+    寫入違規紀錄「之前」呼叫：彙總表不存在時先補建 (回填只會包含已提交的紀錄)。
+    回傳 (寫入後是否需要遞增彙總, 目前的回填世代)。
+    """
+    with summary_table_lock:
+        if not summary_table_ready:
+            ensure_summary_table()
+        return summary_table_ready, summary_generation
+
+def update_daily_summary(day, violation_type, generation):
+    """
+    遞增每日彙總；失敗只記錄錯誤，原始 violations 紀錄不受影響。
+    整段持有 summary_table_lock，回填與遞增不會交錯；紀錄寫入後若彙總表曾被重建回填，
+    回填可能已包含這筆，因此不再遞增。
+    """
+    global summary_table_ready
+    with summary_table_lock:
+        if generation != summary_generation:
+            return
+        conn = None
+        cursor = None
+        try:
+            conn = mysql.connector.connect(**db_config)
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO violation_daily_summary (day, violation_type, count) VALUES (%s, %s, 1) "
+                "ON DUPLICATE KEY UPDATE count = count + 1",
+                (day, violation_type)
+            )
+            conn.commit()
+        except mysql.connector.Error as err:
+            if err.errno == errorcode.ER_NO_SUCH_TABLE:
+                # 彙總表被刪除：下一筆紀錄寫入前重新建立並回填 (回填會包含這筆)
+                summary_table_ready = False
+            logging.error(f"資料庫錯誤 (更新每日彙總): {err}")
+        except Exception as e:
+            logging.error(f"更新每日彙總時發生未知錯誤: {e}", exc_info=True)
+        finally:
+            if cursor: cursor.close()
+            if conn and conn.is_connected(): conn.close()
+
+def save_violation_record(violation_type, evidence_key):
+    # 彙總表未就緒時 (建表失敗)，這筆紀錄之後由建表時的回填計入
+    summary_ready, generation = prepare_daily_summary()
     conn = None
     cursor = None
+    saved = False
     try:
         conn = mysql.connector.connect(**db_config)
         cursor = conn.cursor()
-        timestamp = datetime.now().isoformat()
+        now = datetime.now()
         cursor.execute(
             "INSERT INTO violations (timestamp, violation_type, image_path) VALUES (%s, %s, %s)",
-            (timestamp, violation_type, image_path)
+            (now.isoformat(), violation_type, evidence_key)
         )
         conn.commit()
+        saved = True
         logging.info(f"違規紀錄已儲存: {violation_type}")
     except mysql.connector.Error as err:
         logging.error(f"資料庫錯誤 (儲存違規紀錄): {err}")
@@ -78,6 +222,53 @@ def save_violation_record(violation_type, image_path):
     finally:
         if cursor: cursor.close()
         if conn and conn.is_connected(): conn.close()
+    # 原始紀錄先提交，彙總更新失敗也不會連帶遺失違規紀錄
+    if saved and summary_ready:
+        update_daily_summary(now.date(), violation_type, generation)
+
+def get_daily_summary(start_date, end_date):
+    rows = []
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(**db_config)
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            "SELECT day, violation_type, count FROM violation_daily_summary WHERE day >= %s AND day <= %s",
+            (start_date, end_date)
+        )
+        rows = cursor.fetchall()
+    except mysql.connector.Error as err:
+        logging.error(f"資料庫錯誤 (查詢每日彙總): {err}")
+    except Exception as e:
+        logging.error(f"查詢每日彙總時發生未知錯誤: {e}", exc_info=True)
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+    return rows
+
+def get_recent_evidence(start_time_iso, end_time_iso, limit=3):
+    keys = []
+    conn = None
+    cursor = None
+    try:
+        conn = mysql.connector.connect(**db_config)
+        cursor = conn.cursor()
+        cursor.execute(
+            # 同一張照片可能對應多筆紀錄 (多種違規或重複傳送，key 相同)，依 key 去重
+            "SELECT image_path FROM violations WHERE timestamp >= %s AND timestamp < %s AND image_path IS NOT NULL "
+            "GROUP BY image_path ORDER BY MAX(timestamp) DESC LIMIT %s",
+            (start_time_iso, end_time_iso, limit)
+        )
+        keys = [row[0] for row in cursor.fetchall()]
+    except mysql.connector.Error as err:
+        logging.error(f"資料庫錯誤 (查詢證據圖片): {err}")
+    except Exception as e:
+        logging.error(f"查詢證據圖片時發生未知錯誤: {e}", exc_info=True)
+    finally:
+        if cursor: cursor.close()
+        if conn and conn.is_connected(): conn.close()
+    return keys
 
 def get_violations_by_date(start_time_iso, end_time_iso):
     records = []
@@ -121,9 +312,45 @@ def callback():
         logging.error(f"處理 Webhook 時發生錯誤: {e}", exc_info=True)
     return 'OK'
 
+# --- 檢測器預篩統計 (略過率等) ---
+@app.route("/stats", methods=['GET'])
+def stats():
+    if detector is None:
+        abort(503)
+    return jsonify(detector.get_stats())
+
+# --- 報表圖片與縮圖 (供 LINE 圖片訊息取用) ---
+@app.route("/media/<kind>/<filename>", methods=['GET'])
+def media(kind, filename):
+    if kind == 'reports':
+        return send_from_directory(os.path.abspath(REPORT_DIR), filename, max_age=86400)
+    key = filename[:-4] if filename.endswith('.jpg') else ''
+    if kind == 'thumbs' and evidence_store and evidence_store.exists(key):
+        return send_file(os.path.abspath(evidence_store.thumbnail_path(key)), mimetype='image/jpeg', max_age=86400)
+    abort(404)
+
+def build_report_messages(start_time, end_time):
+    """組出統計報表的回覆訊息：文字彙總 + 趨勢圖 + 最近的證據縮圖 (最多 5 則)。"""
+    end_date = (end_time - timedelta(microseconds=1)).date()
+    days, types, counts = summarize(get_daily_summary(start_time.date(), end_date), start_time.date(), end_date)
+    messages = [text_message(format_report_text(days, types, counts))]
+    if not public_base_url or counts.sum() == 0:
+        return messages
+
+    chart = render_trend_chart(days, types, counts)
+    messages.append(image_message(f"{public_base_url}/media/reports/{chart}"))
+    if evidence_store:
+        # 舊紀錄的 image_path 是 ./temp 路徑，不在證據儲存內，直接略過
+        for key in get_recent_evidence(start_time.isoformat(), end_time.isoformat()):
+            if evidence_store.exists(key):
+                messages.append(image_message(f"{public_base_url}/media/thumbs/{key}.jpg"))
+    return messages[:5]
+
 # --- 處理照片訊息 (精簡 Log 和錯誤處理流程) ---
 @handler.add(MessageEvent, message=ImageMessage)
 def handle_image_message(event):
+    if is_duplicate_event(event):
+        return
     logging.info(f"收到來自使用者 {event.source.user_id} 的圖片訊息")
     message_id = event.message.id
     temp_dir = './temp'
@@ -149,21 +376,37 @@ def handle_image_message(event):
             try:
                 result_list = detector.detect(image_path)
                 if not result_list: raise Exception("檢測器未返回有效結果")
-                result = result_list[0] # 取第一個結果
+                result = result_list[0] # 非違規時只會有一個結果
+                violation_types = [r.get("violation_type", "未知違規") for r in result_list if r.get("violation_detected")]
 
-                if result.get("violation_detected"):
-                    violation_type = result.get("violation_type", "未知違規")
+                if violation_types:
+                    violation_type = "、".join(violation_types)
                     logging.info(f"偵測到違規: {violation_type}")
 
-                    # 儲存紀錄 (如果失敗，不影響後續回覆)
-                    try:
-                         save_violation_record(violation_type, image_path)
-                    except Exception as db_err:
-                         logging.error(f"儲存違規紀錄失敗 (但不中斷): {db_err}")
+                    # 證據圖片存入內容定址儲存，紀錄只保存 key
+                    evidence_key = None
+                    if evidence_store:
+                        try:
+                            evidence_key = evidence_store.put(image_path)
+                        except Exception as store_err:
+                            logging.error(f"儲存證據圖片失敗 (但不中斷): {store_err}")
 
-                    # 查詢法規 & 生成回覆
-                    context = search_laws(violation_type)
-                    response_text = generate_response(violation_type, context)
+                    # 每種違規各存一筆紀錄 (如果失敗，不影響後續回覆)
+                    for single_type in violation_types:
+                        try:
+                             save_violation_record(single_type, evidence_key)
+                        except Exception as db_err:
+                             logging.error(f"儲存違規紀錄失敗 (但不中斷): {db_err}")
+
+                    # 通知工地主管 (進入發送佇列，不阻塞回覆)
+                    if messenger and supervisor_ids:
+                        alert_text = f"⚠️ 工地違規警示：{violation_type}\n時間：{datetime.now().strftime('%Y-%m-%d %H:%M')}"
+                        messenger.multicast(supervisor_ids, [text_message(alert_text)])
+
+                    # 查詢法規 (每種違規分別查詢) & 生成回覆
+                    context = search_laws_for_violations(violation_types)
+                    response_text = generate_response(
+                        "、".join(VIOLATION_LAW_QUERIES.get(t, t) for t in violation_types), context)
                     logging.info("已生成違規分析回覆。")
 
                 elif result.get("violation_type"): # Detector 返回了非違規的訊息 (通常是錯誤)
@@ -182,16 +425,19 @@ def handle_image_message(event):
         # 捕捉儲存圖片或更早期的錯誤
         logging.error(f"處理圖片訊息時發生錯誤: {e}", exc_info=True)
         # 使用預設的錯誤訊息
+    finally:
+        # 暫存圖片用完即刪，證據已另存於 evidence_store
+        try:
+            if os.path.exists(image_path): os.remove(image_path)
+        except OSError as rm_err:
+            logging.warning(f"刪除暫存圖片失敗: {rm_err}")
 
     # --- 統一回覆 ---
     try:
-        if line_bot_api:
+        if messenger:
             log_response_preview = response_text.replace('\n', ' ')[:80] # Log 短一點
             logging.info(f"準備回覆使用者: {log_response_preview}...")
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=response_text)
-            )
+            messenger.reply(event.reply_token, [text_message(response_text)])
         else:
              logging.error("Line Bot API 未初始化，無法回覆。")
     except Exception as reply_e:
@@ -201,11 +447,26 @@ def handle_image_message(event):
 # --- 處理文字訊息 (精簡 Log) ---
 @handler.add(MessageEvent, message=TextMessage)
 def handle_text_message(event):
+    if is_duplicate_event(event):
+        return
     user_text = event.message.text
     logging.info(f"收到來自使用者 {event.source.user_id} 的文字訊息: {user_text[:50]}...") # Log 短一點
-    response = "請上傳照片進行違規檢測，或輸入 '查詢 [時間範圍] 違規' (例如: 查詢今天違規)。" # 預設回覆
+    response = "請上傳照片進行違規檢測，或輸入 '查詢 [時間範圍] 違規' (例如: 查詢今天違規、查詢本週違規統計)。" # 預設回覆
+    messages = None # 報表模式會回覆多則訊息
+
+    if "違規" in user_text and "統計" in user_text and ("查詢" in user_text or "查看" in user_text):
+        try:
+            start_time, end_time = parse_natural_language_time(user_text)
+            if start_time and end_time:
+                logging.info(f"統計報表範圍: {start_time.isoformat()} 到 {end_time.isoformat()}")
+                messages = build_report_messages(start_time, end_time)
+            else:
+                response = "⚠️ 無法解析時間範圍，請試試 '本週', '上個月', '最近7天' 等。"
+        except Exception as report_e:
+            logging.error(f"產生統計報表時出錯: {report_e}", exc_info=True)
+            response = "產生統計報表時發生錯誤。"
 
-    if "違規" in user_text and ("查詢" in user_text or "查看" in user_text):
+    elif "違規" in user_text and ("查詢" in user_text or "查看" in user_text):
         try:
             start_time, end_time = parse_natural_language_time(user_text)
             if start_time and end_time:
@@ -234,13 +495,10 @@ def handle_text_message(event):
 
     # --- 回覆文字訊息 ---
     try:
-        if line_bot_api:
-            log_response_preview = response.replace('\n', ' ')[:80]
+        if messenger:
+            log_response_preview = (messages[0]["text"] if messages else response).replace('\n', ' ')[:80]
             logging.info(f"準備回覆使用者: {log_response_preview}...")
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=response)
-            )
+            messenger.reply(event.reply_token, messages or [text_message(response)])
         else:
              logging.error("Line Bot API 未初始化，無法回覆。")
     except Exception as e:
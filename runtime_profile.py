@@ -0,0 +1,204 @@
+# runtime_profile.py
+# 偵測器 / 嵌入模型的 CPU 執行設定：torch 執行緒數、inference_mode、channels_last、CPU 綁定
+#
+# 設定來源 (後者覆蓋前者)：預設值 -> RUNTIME_PROFILE_PATH 的 JSON 檔 -> 環境變數
+# 在本機找出最佳設定：
+#   python runtime_profile.py bench --images ./temp --rounds 5
+import argparse
+import contextlib
+import glob
+import itertools
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+RUNTIME_PROFILE_PATH = os.getenv('RUNTIME_PROFILE_PATH', './data/runtime_profile.json')
+
+DEFAULT_PROFILE = {
+    "intra_op_threads": None,   # None = 沿用 torch 預設
+    "inter_op_threads": None,
+    "inference_mode": True,
+    "channels_last": False,
+    "cpu_affinity": None,       # 例如 [0, 1, 2, 3]
+}
+
+_applied = False
+
+
+def parse_cpu_list(value):
+    """解析 "0-3,6" 這類 CPU 清單。"""
+    cpus = []
+    for part in str(value).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return sorted(set(cpus)) or None
+
+def _env_bool(name):
+    value = os.getenv(name)
+    return None if value is None else value.lower() == 'true'
+
+def load_runtime_profile(path=RUNTIME_PROFILE_PATH):
+    profile = dict(DEFAULT_PROFILE)
+    if path and os.path.exists(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                profile.update({k: v for k, v in json.load(f).items() if k in DEFAULT_PROFILE})
+            logging.info(f"已載入執行設定檔: {path}")
+        except Exception as e:
+            logging.error(f"讀取執行設定檔失敗 ({path})，改用預設值: {e}")
+
+    overrides = {
+        "intra_op_threads": os.getenv('TORCH_INTRA_OP_THREADS'),
+        "inter_op_threads": os.getenv('TORCH_INTER_OP_THREADS'),
+        "inference_mode": _env_bool('TORCH_INFERENCE_MODE'),
+        "channels_last": _env_bool('TORCH_CHANNELS_LAST'),
+        "cpu_affinity": os.getenv('CPU_AFFINITY'),
+    }
+    for key, value in overrides.items():
+        if value is None or value == '':
+            continue
+        if key in ("intra_op_threads", "inter_op_threads"):
+            value = int(value)
+        elif key == "cpu_affinity":
+            value = parse_cpu_list(value)
+        profile[key] = value
+    return profile
+
+def apply_runtime_profile(profile):
+    """
+    套用行程層級的設定 (CPU 綁定與 torch 執行緒數)。torch 的執行緒設定對整個行程生效，
+    偵測器與 HuggingFace 嵌入模型共用；重複呼叫只有第一次有效。
+    """
+    global _applied
+    if _applied:
+        return
+    _applied = True
+
+    if profile.get("cpu_affinity") and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, profile["cpu_affinity"])
+            logging.info(f"CPU 綁定: {profile['cpu_affinity']}")
+        except OSError as e:
+            logging.warning(f"設定 CPU 綁定失敗: {e}")
+
+    import torch
+    if profile.get("intra_op_threads"):
+        torch.set_num_threads(int(profile["intra_op_threads"]))
+    if profile.get("inter_op_threads"):
+        try:
+            torch.set_num_interop_threads(int(profile["inter_op_threads"]))
+        except RuntimeError as e:
+            # inter-op 執行緒數只能在第一次平行運算前設定
+            logging.warning(f"無法設定 inter-op 執行緒數: {e}")
+    logging.info(f"torch 執行緒: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+def prepare_model(model, profile):
+    if profile.get("channels_last"):
+        import torch
+        model.to(memory_format=torch.channels_last)
+    return model
+
+def inference_context(profile):
+    import torch
+    return torch.inference_mode() if profile.get("inference_mode", True) else contextlib.nullcontext()
+
+
+# --- 基準測試：每組設定在獨立子行程中執行 (inter-op 執行緒數每個行程只能設定一次) ---
+def _trial(profile, image_paths, rounds):
+    from yolo_detector import SafetyViolationDetector
+    detector = SafetyViolationDetector(runtime_profile=profile)
+    if detector.model is None:
+        raise RuntimeError("模型載入失敗")
+    detector.detect(image_paths[0])  # 暖機
+    latencies = []
+    for _ in range(rounds):
+        for image_path in image_paths:
+            t0 = time.perf_counter()
+            detector.detect(image_path)
+            latencies.append(time.perf_counter() - t0)
+    return {"median_ms": statistics.median(latencies) * 1000,
+            "p90_ms": sorted(latencies)[int(len(latencies) * 0.9) - 1] * 1000}
+
+def _candidate_threads(cpu_count):
+    counts = {1, cpu_count}
+    n = 2
+    while n < cpu_count:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+def benchmark(image_dir, rounds, out_path, max_images, cpu_affinity):
+    image_paths = sorted(glob.glob(os.path.join(image_dir, '*.jpg')))[:max_images]
+    if not image_paths:
+        logging.error(f"在 {image_dir} 找不到測試圖片 (*.jpg)")
+        return None
+    cpu_count = len(cpu_affinity) if cpu_affinity else (os.cpu_count() or 1)
+    results = []
+    for intra, inter, channels_last, inference_mode in itertools.product(
+            _candidate_threads(cpu_count), (1, 2), (False, True), (True, False)):
+        profile = dict(DEFAULT_PROFILE, intra_op_threads=intra, inter_op_threads=inter, channels_last=channels_last,
+                       inference_mode=inference_mode, cpu_affinity=cpu_affinity)
+        env = dict(os.environ, DETECTOR_PRESCREEN='false', RUNTIME_PROFILE_PATH='', SHADOW_MODEL_PATH='')
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '_trial', '--profile', json.dumps(profile),
+             '--images', *image_paths, '--rounds', str(rounds)],
+            capture_output=True, text=True, env=env
+        )
+        if proc.returncode != 0:
+            logging.warning(f"設定 {profile} 執行失敗: {proc.stderr.strip().splitlines()[-1:]}")
+            continue
+        metrics = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append((metrics["median_ms"], profile, metrics))
+        logging.info(f"intra={intra} inter={inter} channels_last={channels_last} inference_mode={inference_mode}: "
+                     f"median {metrics['median_ms']:.1f} ms, p90 {metrics['p90_ms']:.1f} ms")
+
+    if not results:
+        logging.error("所有設定皆執行失敗，未寫出設定檔。")
+        return None
+    results.sort(key=lambda item: item[0])
+    # YOLOv5 的 AutoShape.forward 本身已在 inference mode 下執行，外層的開關對偵測器可能沒有差別；
+    # 列出開 / 關各自的最佳結果，讓差異 (或沒有差異) 直接可見
+    for mode in (True, False):
+        best = next((ms for ms, profile, _ in results if profile["inference_mode"] is mode), None)
+        if best is not None:
+            logging.info(f"inference_mode={mode} 最佳: {best:.1f} ms/張")
+    best_ms, best_profile, _ = results[0]
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(best_profile, f, indent=2)
+    logging.info(f"✅ 最佳設定 ({best_ms:.1f} ms/張) 已寫入 {out_path}: {best_profile}")
+    return best_profile
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="偵測器 CPU 執行設定基準測試")
+    sub = parser.add_subparsers(dest='command', required=True)
+    bench = sub.add_parser('bench', help='掃描執行緒數、channels_last 與 inference_mode 並寫出最佳設定檔')
+    bench.add_argument('--images', default='./temp', help='測試圖片目錄 (*.jpg)')
+    bench.add_argument('--rounds', type=int, default=3)
+    bench.add_argument('--max-images', type=int, default=10)
+    bench.add_argument('--cpu-affinity', default=None, help='例如 0-3，會一併寫入設定檔')
+    bench.add_argument('--out', default=RUNTIME_PROFILE_PATH)
+    trial = sub.add_parser('_trial')
+    trial.add_argument('--profile', required=True)
+    trial.add_argument('--images', nargs='+', required=True)
+    trial.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        affinity = parse_cpu_list(args.cpu_affinity) if args.cpu_affinity else None
+        sys.exit(0 if benchmark(args.images, args.rounds, args.out, args.max_images, affinity) else 1)
+    else:
+        print(json.dumps(_trial(json.loads(args.profile), args.images, args.rounds)))
@@ -0,0 +1,233 @@
+# shadow_eval.py
+# 候選模型 (新 best.pt) 影子評估：抽樣部分圖片在背景執行候選模型，記錄判定是否一致與延遲差異
+#
+# 啟用：設定 SHADOW_MODEL_PATH=./candidate.pt (可選 SHADOW_SAMPLE_RATE、SHADOW_MAX_PENDING)
+# 離線檢視：python shadow_eval.py report
+import contextlib
+import json
+import logging
+import os
+import queue
+import random
+import sqlite3
+import statistics
+import threading
+import time
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+SHADOW_MODEL_PATH = os.getenv('SHADOW_MODEL_PATH', '')
+SHADOW_SAMPLE_RATE = float(os.getenv('SHADOW_SAMPLE_RATE', 0.1))
+SHADOW_MAX_PENDING = int(os.getenv('SHADOW_MAX_PENDING', 2))     # 背景佇列上限，滿了就丟棄樣本
+SHADOW_DB_PATH = os.getenv('SHADOW_DB_PATH', './data/shadow_eval.sqlite3')
+VERDICT_CLASSES = ("head", "helmet")
+VERDICT_MIN_CONF = 0.25
+
+
+def count_classes(detections, names_map, class_names=VERDICT_CLASSES, min_conf=VERDICT_MIN_CONF):
+    """統計指定類別 (預設 head / helmet) 的偵測數量。"""
+    detections = np.asarray(detections, dtype=np.float32).reshape(-1, 6)
+    lookup = {str(name).lower(): int(class_id) for class_id, name in names_map.items()}
+    confident = detections[detections[:, 4] >= min_conf]
+    return {name: int((confident[:, 5].astype(np.int64) == lookup[name]).sum()) if name in lookup else 0
+            for name in class_names}
+
+
+class ShadowResultStore:
+    """
+    影子評估結果表 (本地 SQLite)，供離線檢視。image_ref 為圖片內容的 SHA-256，
+    有違規的圖片可用同一個 key 在 EvidenceStore 找到。
+    """
+
+    def __init__(self, path=SHADOW_DB_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS shadow_results (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   created_at REAL NOT NULL,
+                   image_ref TEXT,
+                   inference_size INTEGER,
+                   primary_violations TEXT NOT NULL,
+                   candidate_violations TEXT NOT NULL,
+                   primary_counts TEXT NOT NULL,
+                   candidate_counts TEXT NOT NULL,
+                   verdict_agree INTEGER NOT NULL,
+                   primary_ms REAL NOT NULL,
+                   candidate_ms REAL NOT NULL)"""
+        )
+        self.conn.commit()
+
+    def add(self, row):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO shadow_results (created_at, image_ref, inference_size, primary_violations, "
+                "candidate_violations, primary_counts, candidate_counts, verdict_agree, primary_ms, candidate_ms) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), row["image_ref"], row["inference_size"], json.dumps(row["primary_violations"]),
+                 json.dumps(row["candidate_violations"]), json.dumps(row["primary_counts"]),
+                 json.dumps(row["candidate_counts"]), int(row["verdict_agree"]), row["primary_ms"], row["candidate_ms"])
+            )
+            self.conn.commit()
+
+    def rows(self, since=None):
+        with self.lock:
+            cursor = self.conn.execute(
+                "SELECT primary_violations, candidate_violations, primary_counts, candidate_counts, "
+                "verdict_agree, primary_ms, candidate_ms FROM shadow_results WHERE created_at >= ?",
+                (since or 0,)
+            )
+            return [{"primary_violations": json.loads(r[0]), "candidate_violations": json.loads(r[1]),
+                     "primary_counts": json.loads(r[2]), "candidate_counts": json.loads(r[3]),
+                     "verdict_agree": bool(r[4]), "primary_ms": r[5], "candidate_ms": r[6]}
+                    for r in cursor.fetchall()]
+
+
+class ShadowEvaluator:
+    """
+    在主流程之外以單一背景執行緒跑候選模型。主流程只做抽樣判斷與 put_nowait，佇列滿時直接丟棄樣本。
+    兩個模型共用同一個 torch 執行緒池，因此候選模型只在沒有主模型推論進行時才開始 forward
+    (忙碌時樣本留在佇列或被丟棄)，主流程最多被一次已開始的候選推論拖慢；
+    主模型推論期間候選模型仍在跑的樣本延遲不準，直接捨棄。
+    """
+
+    def __init__(self, model, names_map, rule_engine, inference_context, primary_names_map, store=None,
+                 sample_rate=SHADOW_SAMPLE_RATE, max_pending=SHADOW_MAX_PENDING):
+        self.model = model
+        self.names_map = names_map
+        self.primary_names_map = primary_names_map
+        self.rule_engine = rule_engine
+        self.inference_context = inference_context
+        self.store = store or ShadowResultStore()
+        self.sample_rate = sample_rate
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.stats = {"submitted": 0, "dropped": 0, "contended": 0, "evaluated": 0, "failed": 0}
+        self.stats_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._primary_active = 0
+        self._candidate_running = False
+        self._local = threading.local()
+        self.worker = threading.Thread(target=self._run, name="shadow-eval", daemon=True)
+        self.worker.start()
+        logging.info(f"影子評估啟用：抽樣率 {sample_rate:.0%}，佇列上限 {max_pending}")
+
+    def _count(self, name):
+        # Flask 執行緒與背景執行緒都會更新計數
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def sample(self):
+        """每張圖片開始時呼叫 (在任何預篩之前)：回傳是否抽中，並重設本執行緒的資源競爭標記。"""
+        self._local.contended = False
+        return random.random() < self.sample_rate
+
+    @contextlib.contextmanager
+    def primary_pass(self):
+        """包住主模型的每次 forward；進行中時候選模型不會開始推論。"""
+        with self._cond:
+            self._primary_active += 1
+            if self._candidate_running:
+                self._local.contended = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._primary_active -= 1
+                self._cond.notify_all()
+
+    def submit(self, frame, image_ref, inference_size, primary_detections, primary_violations, primary_ms):
+        """送出抽中的樣本；主模型推論時與候選模型重疊的樣本不列入 (primary_ms 受干擾)。"""
+        if getattr(self._local, 'contended', False):
+            self._count("contended")
+            return
+        try:
+            self.pending.put_nowait((frame, image_ref, inference_size, primary_detections, primary_violations, primary_ms))
+            self._count("submitted")
+        except queue.Full:
+            self._count("dropped")
+
+    def _run(self):
+        while True:
+            frame, image_ref, inference_size, primary_detections, primary_violations, primary_ms = self.pending.get()
+            try:
+                primary_counts = count_classes(primary_detections, self.primary_names_map)
+                with self._cond:
+                    self._cond.wait_for(lambda: self._primary_active == 0)
+                    self._candidate_running = True
+                try:
+                    t0 = time.perf_counter()
+                    with self.inference_context():
+                        detections = self.model(frame, size=inference_size)
+                    candidate_ms = (time.perf_counter() - t0) * 1000
+                finally:
+                    with self._cond:
+                        self._candidate_running = False
+                processed = detections.xyxy[0].cpu().numpy()
+                candidate_violations = self.rule_engine.evaluate(processed, frame.shape)
+                candidate_counts = count_classes(processed, self.names_map)
+                self.store.add({
+                    "image_ref": image_ref,
+                    "inference_size": inference_size,
+                    "primary_violations": primary_violations,
+                    "candidate_violations": candidate_violations,
+                    "primary_counts": primary_counts,
+                    "candidate_counts": candidate_counts,
+                    "verdict_agree": set(primary_violations) == set(candidate_violations),
+                    "primary_ms": primary_ms,
+                    "candidate_ms": candidate_ms,
+                })
+                self._count("evaluated")
+            except Exception as e:
+                self._count("failed")
+                logging.error(f"影子評估失敗: {e}", exc_info=True)
+            finally:
+                self.pending.task_done()
+
+
+def summarize_results(rows):
+    """整理一致率、各規則的分歧數與兩個模型的延遲。"""
+    if not rows:
+        return None
+    disagreements = {}
+    for row in rows:
+        for name in set(row["primary_violations"]) ^ set(row["candidate_violations"]):
+            side = "primary_only" if name in row["primary_violations"] else "candidate_only"
+            disagreements.setdefault(name, {"primary_only": 0, "candidate_only": 0})[side] += 1
+
+    def latency(key):
+        values = sorted(row[key] for row in rows)
+        return {"median_ms": statistics.median(values), "p90_ms": values[max(0, int(len(values) * 0.9) - 1)]}
+
+    count_diffs = {name: sum(abs(row["candidate_counts"].get(name, 0) - row["primary_counts"].get(name, 0)) for row in rows)
+                   for name in VERDICT_CLASSES}
+    return {
+        "samples": len(rows),
+        "agreement_rate": sum(row["verdict_agree"] for row in rows) / len(rows),
+        "disagreements": disagreements,
+        "count_abs_diff": count_diffs,
+        "primary_latency": latency("primary_ms"),
+        "candidate_latency": latency("candidate_ms"),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="候選模型影子評估結果")
+    parser.add_argument('command', choices=['report'])
+    parser.add_argument('--db', default=SHADOW_DB_PATH)
+    parser.add_argument('--days', type=float, default=None, help='只看最近 N 天')
+    args = parser.parse_args()
+
+    since = time.time() - args.days * 86400 if args.days else None
+    summary = summarize_results(ShadowResultStore(args.db).rows(since))
+    if summary is None:
+        print("尚無影子評估紀錄。")
+    else:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
@@ -0,0 +1,38 @@
+from datetime import datetime
+
+import pytest
+
+from event_analyzer import parse_natural_language_time
+
+NOW = datetime(2025, 4, 16, 15, 30)  # 星期三
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("今天", (datetime(2025, 4, 16), datetime(2025, 4, 17))),
+    ("昨天", (datetime(2025, 4, 15), datetime(2025, 4, 16))),
+    ("本週", (datetime(2025, 4, 14), datetime(2025, 4, 21))),
+    ("上週", (datetime(2025, 4, 7), datetime(2025, 4, 14))),
+    ("上上週", (datetime(2025, 3, 31), datetime(2025, 4, 7))),
+    ("這個月", (datetime(2025, 4, 1), datetime(2025, 5, 1))),
+    ("上個月", (datetime(2025, 3, 1), datetime(2025, 4, 1))),
+    ("上上個月", (datetime(2025, 2, 1), datetime(2025, 3, 1))),
+    ("最近3天", (datetime(2025, 4, 14), datetime(2025, 4, 17))),
+    ("最近24小時", (datetime(2025, 4, 15, 15, 30), NOW)),
+    ("最近一個月", (datetime(2025, 3, 17), datetime(2025, 4, 17))),
+    ("最近1個月", (datetime(2025, 3, 17), datetime(2025, 4, 17))),
+    ("最近3個月", (datetime(2025, 1, 17), datetime(2025, 4, 17))),
+    ("過去兩週", (datetime(2025, 4, 3), datetime(2025, 4, 17))),
+    ("过去两周", (datetime(2025, 4, 3), datetime(2025, 4, 17))),
+    ("4/1到4/10", (datetime(2025, 4, 1), datetime(2025, 4, 11))),
+    ("4/10到4/1", (datetime(2025, 4, 1), datetime(2025, 4, 11))),
+    ("12/25到1/5", (datetime(2024, 12, 25), datetime(2025, 1, 6))),
+    ("2024/12/25到2025/1/5", (datetime(2024, 12, 25), datetime(2025, 1, 6))),
+    ("4/1", (datetime(2025, 4, 1), datetime(2025, 4, 2))),
+    ("12/25", (datetime(2024, 12, 25), datetime(2024, 12, 26))),
+    ("2/30", (None, None)),
+    ("最近99999999天", (None, None)),
+    ("", (None, None)),
+    ("哈囉", (None, None)),
+])
+def test_parse_natural_language_time(text, expected):
+    assert parse_natural_language_time(text, now=NOW) == expected
@@ -0,0 +1,111 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+
+from line_messenger import LineMessenger, SendQueue, text_message
+
+
+class MockLineServer:
+    """本地 LINE API 模擬：記錄每個請求，依序回傳預先排好的 (status, headers)，沒有排程時回 200。"""
+
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                server.requests.append({"path": self.path, "retry_key": self.headers.get('X-Line-Retry-Key'),
+                                        "body": body})
+                status, headers = server.responses.pop(0) if server.responses else (200, {})
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    mock = MockLineServer()
+    yield mock
+    mock.close()
+
+
+@pytest.fixture
+def messenger(server):
+    return LineMessenger('test-token', endpoint=server.url, queue=SendQueue(':memory:'), backoff_base=0)
+
+
+def test_reply_waits_for_retry_after_then_succeeds(server, messenger):
+    server.responses = [(429, {'Retry-After': '1'})]
+    t0 = time.monotonic()
+    assert messenger.reply('reply-token', [text_message('hi')])
+    assert time.monotonic() - t0 >= 1.0
+    assert [r["path"] for r in server.requests] == ['/v2/bot/message/reply'] * 2
+
+
+def test_queued_429_is_rescheduled_after_retry_after(server, messenger):
+    server.responses = [(429, {'Retry-After': '30'})]
+    messenger.push('U1', [text_message('hi')])
+    assert messenger.flush() == 1
+    assert messenger.queue.due() == []
+    assert messenger.queue.pending_count() == 1
+
+
+def test_5xx_retry_reuses_retry_key(server, messenger):
+    server.responses = [(503, {})]
+    messenger.push('U1', [text_message('hi')])
+    assert messenger.flush() == 1
+    assert messenger.flush() == 1
+    assert len(server.requests) == 2
+    first, second = server.requests
+    assert first["retry_key"] and first["retry_key"] == second["retry_key"]
+    assert first["body"] == second["body"]
+    assert messenger.queue.pending_count() == 0
+
+
+def test_multicasts_to_same_recipients_are_merged_into_batches_of_five(server, messenger):
+    for i in range(7):
+        messenger.multicast(['U2', 'U1'], [text_message(f'alert {i}')])
+    assert messenger.flush() == 2
+    assert [len(r["body"]["messages"]) for r in server.requests] == [5, 2]
+    assert all(r["body"]["to"] == ['U1', 'U2'] for r in server.requests)
+    assert len({r["retry_key"] for r in server.requests}) == 2
+    assert messenger.queue.pending_count() == 0
+
+
+def test_multicast_recipients_are_split_into_chunks_of_500(server, messenger):
+    user_ids = [f'U{i:04d}' for i in range(1200)]
+    messenger.multicast(user_ids, [text_message('alert')])
+    assert messenger.flush() == 3
+    assert sorted(len(r["body"]["to"]) for r in server.requests) == [200, 500, 500]
+    assert sorted(uid for r in server.requests for uid in r["body"]["to"]) == user_ids
+
+
+def test_due_never_splits_a_keyed_batch():
+    queue = SendQueue(':memory:')
+    for i in range(5):
+        queue.put('push', 'U1', [text_message(str(i))])
+    ids = [row["id"] for row in queue.due()]
+    queue.assign_retry_key(ids, 'retry-key')
+    assert [row["id"] for row in queue.due(limit=2)] == ids
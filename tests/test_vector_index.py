@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from core.vector_index import FLAT_INDEX_PATH, FlatVectorIndex
+
+DOCUMENTS = ["雇主對於進入營繕工程工作場所作業人員，應使其確實使用安全帽。",
+             "雇主對於高度二公尺以上之作業，應使勞工確實使用安全帶。",
+             "夜間作業人員應穿著反光背心。",
+             "施工架應由專人設計及查驗。"]
+METADATAS = [{"article_number": "第281條", "chapter": "第十一章 防護具"},
+             {"article_number": "第225條", "chapter": "第九章 墜落災害之防止"},
+             {"article_number": "第21條", "chapter": "第二章 通則"},
+             {"article_number": "第40條", "chapter": "第五章 施工架"}]
+
+
+def make_embeddings(seed=0, dim=16):
+    return np.random.default_rng(seed).normal(size=(len(DOCUMENTS), dim)).astype(np.float32)
+
+
+@pytest.mark.parametrize("dtype, atol", [("float16", 1e-3), ("int8", 2e-2)])
+def test_save_load_roundtrip(tmp_path, dtype, atol):
+    embeddings = make_embeddings()
+    index = FlatVectorIndex.from_embeddings(embeddings, DOCUMENTS, METADATAS, dtype)
+    path = tmp_path / "law_index.npz"
+    index.save(str(path))
+    loaded = FlatVectorIndex.load(str(path))
+
+    assert loaded.dtype == np.dtype(dtype)
+    assert loaded.documents == DOCUMENTS
+    assert loaded.metadatas == METADATAS
+    np.testing.assert_array_equal(loaded.stored_vectors(), index.stored_vectors())
+    normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    np.testing.assert_allclose(loaded.matrix, normalized, atol=atol)
+    query = embeddings[1]
+    assert loaded.search(query, k=2) == index.search(query, k=2)
+    assert loaded.search(query, k=1)[0][2] == METADATAS[1]
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_search_orders_by_score(dtype):
+    embeddings = np.array([[1, 0, 0], [0.8, 0.6, 0], [0, 1, 0], [0.6, 0, 0.8]], dtype=np.float32)
+    index = FlatVectorIndex.from_embeddings(embeddings, DOCUMENTS, METADATAS, dtype)
+    results = index.search([2, 0, 0], k=3)
+    assert [metadata["article_number"] for _, _, metadata in results] == ["第281條", "第225條", "第40條"]
+    scores = [score for score, _, _ in results]
+    assert scores == sorted(scores, reverse=True)
+    assert scores[0] == pytest.approx(1.0, abs=1e-2)
+
+
+def test_search_k_larger_than_index():
+    index = FlatVectorIndex.from_embeddings(make_embeddings(), DOCUMENTS, METADATAS, "float16")
+    results = index.search(make_embeddings(seed=1)[0], k=10)
+    assert len(results) == len(DOCUMENTS)
+    assert sorted(doc for _, doc, _ in results) == sorted(DOCUMENTS)
+    assert index.search(make_embeddings(seed=1)[0], k=0) == []
+
+
+def test_parity_with_chroma():
+    """輕量索引與 ChromaDB 的 top-k 條號需大致一致 (需要已建立的索引、ChromaDB 與嵌入模型)。"""
+    pytest.importorskip("langchain_community")
+    pytest.importorskip("sentence_transformers")
+    if not os.path.exists(FLAT_INDEX_PATH):
+        pytest.skip(f"尚未建立輕量索引 ({FLAT_INDEX_PATH})，請先執行 python -m core.vector_index build")
+    from core.vector_index import parity_check
+    try:
+        mean_overlap = parity_check()
+    except OSError as e:
+        pytest.skip(f"無法載入嵌入模型: {e}")
+    assert mean_overlap >= 0.8
@@ -0,0 +1,121 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from violation_rules import DEFAULT_RULES, RuleEngine
+
+NAMES = {0: "head", 1: "helmet", 2: "person", 3: "vest"}
+HEAD, HELMET, PERSON, VEST = range(4)
+FRAME = (200, 200, 3)
+
+
+def dets(*rows):
+    """rows: (x1, y1, x2, y2, cls) 或 (x1, y1, x2, y2, cls, conf)；回傳 YOLO 格式的 (N, 6) 陣列。"""
+    out = [[*row[:4], row[5] if len(row) > 5 else 0.9, row[4]] for row in rows]
+    return np.array(out, dtype=np.float32).reshape(-1, 6)
+
+
+def legacy_calculate_iou(box1, box2):
+    # 舊版 yolo_detector.calculate_iou
+    x1_inter = max(box1[0], box2[0])
+    y1_inter = max(box1[1], box2[1])
+    x2_inter = min(box1[2], box2[2])
+    y2_inter = min(box1[3], box2[3])
+    inter_area = max(0, x2_inter - x1_inter) * max(0, y2_inter - y1_inter)
+    box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
+    box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
+    union_area = box1_area + box2_area - inter_area
+    if union_area == 0:
+        return 0.0
+    return inter_area / union_area
+
+
+def legacy_no_helmet(detections, iou_threshold=0.1):
+    # 舊版檢查迴圈：任一 head 沒有 IoU >= 門檻的 helmet 即違規
+    heads = [d[:4] for d in detections if int(d[5]) == HEAD]
+    helmets = [d[:4] for d in detections if int(d[5]) == HELMET]
+    return any(not any(legacy_calculate_iou(h, m) >= iou_threshold for m in helmets) for h in heads)
+
+
+@pytest.fixture
+def engine():
+    return RuleEngine(DEFAULT_RULES, NAMES)
+
+
+@pytest.mark.parametrize("helmet_height, violated", [(1.2, False), (0.8, True)])
+def test_no_helmet_iou_threshold(engine, helmet_height, violated):
+    # head 面積 100，helmet 完全落在 head 內：IoU = helmet_height * 10 / 100
+    detections = dets((0, 0, 10, 10, HEAD), (0, 0, 10, helmet_height, HELMET))
+    assert ("no_helmet" in engine.evaluate(detections, FRAME)) is violated
+    assert legacy_no_helmet(detections) is violated
+
+
+def test_no_helmet_matches_legacy_loop_on_random_scenes(engine):
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        n = rng.integers(0, 6)
+        xy = rng.uniform(0, 150, size=(n, 2))
+        wh = rng.uniform(5, 40, size=(n, 2))
+        cls = rng.integers(0, 2, size=n)
+        detections = np.concatenate([xy, xy + wh, np.full((n, 1), 0.9), cls[:, None]], axis=1).astype(np.float32)
+        result = engine.evaluate(detections, FRAME)
+        assert ("no_helmet" in result) == legacy_no_helmet(detections)
+
+
+def test_no_helmet_counts_every_offender(engine):
+    detections = dets((0, 0, 10, 10, HEAD), (50, 50, 60, 60, HEAD), (100, 100, 110, 110, HEAD),
+                      (0, 0, 10, 10, HELMET))
+    assert engine.evaluate(detections, FRAME)["no_helmet"] == 2
+
+
+def test_low_confidence_detections_are_ignored(engine):
+    detections = dets((0, 0, 10, 10, HEAD, 0.1))
+    assert engine.evaluate(detections, FRAME) == {}
+
+
+@pytest.mark.parametrize("vest, violated", [
+    ((10, 50, 90, 150), False),    # 完全在 person 內
+    ((80, 50, 120, 150), False),   # 一半在內 (containment 0.5)
+    ((90, 50, 130, 150), True),    # 只有 1/4 在內
+    (None, True),
+])
+def test_no_vest_containment(engine, vest, violated):
+    rows = [(0, 0, 100, 200, PERSON)] + ([(*vest, VEST)] if vest else [])
+    assert ("no_vest" in engine.evaluate(dets(*rows), FRAME)) is violated
+
+
+@pytest.mark.parametrize("zone, normalized", [
+    ([[0, 0], [100, 0], [100, 100], [0, 100]], False),
+    ([[0, 0], [0.5, 0], [0.5, 0.5], [0, 0.5]], True),
+])
+def test_in_zone(zone, normalized):
+    rule = {"name": "restricted_zone", "type": "in_zone", "subject": "person", "zones": [zone], "normalized": normalized}
+    engine = RuleEngine([rule], NAMES)
+    # 以框的底部中心判斷：(50, 90) 在禁區內，(150, 90) 與 (50, 190) 在外
+    detections = dets((40, 20, 60, 90, PERSON), (140, 20, 160, 90, PERSON), (40, 120, 60, 190, PERSON))
+    assert engine.evaluate(detections, FRAME) == {"restricted_zone": 1}
+
+
+def test_rules_disabled_when_model_lacks_class():
+    engine = RuleEngine(DEFAULT_RULES, {0: "head", 1: "helmet"})
+    assert [rule.name for rule in engine.rules] == ["no_helmet"]
+    engine = RuleEngine(DEFAULT_RULES, {0: "Person", 1: "Vest"})
+    assert [rule.name for rule in engine.rules] == ["no_vest"]
+
+
+def test_malformed_rules_are_skipped():
+    rules = [
+        {"name": "missing_object", "type": "missing_overlap", "subject": "head"},
+        {"name": "bad_type", "type": "nearby", "subject": "head", "object": "helmet"},
+        {"name": "bad_zone", "type": "in_zone", "subject": "person", "zones": [[[0, 0], [1, 1]]]},
+        {"name": "no_helmet", "type": "missing_overlap", "subject": "head", "object": "helmet", "iou": 0.1},
+    ]
+    engine = RuleEngine(rules, NAMES)
+    assert [rule.name for rule in engine.rules] == ["no_helmet"]
+    assert engine.evaluate(dets((0, 0, 10, 10, HEAD)), FRAME) == {"no_helmet": 1}
+
+
+def test_subject_detections(engine):
+    detections = dets((0, 0, 10, 10, HEAD), (0, 0, 10, 10, HELMET), (0, 0, 50, 100, PERSON, 0.05))
+    assert engine.subject_detections(detections).shape == (2, 6)
+    assert engine.subject_detections(detections, min_conf=0.25)[:, 5].tolist() == [HEAD]
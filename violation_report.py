@@ -0,0 +1,147 @@
+# violation_report.py
+# 違規統計報表：彙整文字與趨勢圖 (OpenCV 繪製)
+import hashlib
+import logging
+import os
+import time
+from datetime import timedelta
+
+import cv2
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+REPORT_DIR = os.getenv('REPORT_DIR', './temp/reports')
+REPORT_MAX_FILES = int(os.getenv('REPORT_MAX_FILES', 200))
+REPORT_MAX_AGE_DAYS = float(os.getenv('REPORT_MAX_AGE_DAYS', 7))   # LINE 取圖後就不再需要，保留數天即可
+
+# 每種違規固定顏色 (BGR)，未列出的類型依序取用
+_PALETTE = [(60, 76, 231), (18, 156, 243), (113, 204, 46), (219, 152, 52), (182, 89, 155), (94, 73, 52)]
+
+
+def _days_in_range(start_date, end_date):
+    """回傳 [start_date, end_date] 之間的每一天 (含頭尾)。"""
+    days = []
+    day = start_date
+    while day <= end_date:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+def summarize(summary_rows, start_date, end_date):
+    """
+    將 violation_daily_summary 的資料列整理成 (days, types, counts)。
+    counts 為 (天數, 類型數) 的矩陣，沒有紀錄的日期補 0。
+    """
+    days = _days_in_range(start_date, end_date)
+    types = sorted({row['violation_type'] for row in summary_rows})
+    day_index = {day: i for i, day in enumerate(days)}
+    type_index = {t: j for j, t in enumerate(types)}
+    counts = np.zeros((len(days), len(types)), dtype=np.int64)
+    for row in summary_rows:
+        i = day_index.get(row['day'])
+        if i is not None:
+            counts[i, type_index[row['violation_type']]] += int(row['count'])
+    return days, types, counts
+
+def format_report_text(days, types, counts):
+    total = int(counts.sum())
+    text = f"📊 違規統計 {days[0].isoformat()} ~ {days[-1].isoformat()} (共 {total} 筆)\n"
+    if total == 0:
+        return text + "✅ 此期間內無違規紀錄。"
+    text += "各類型：" + "、".join(f"{t} {int(c)}" for t, c in zip(types, counts.sum(axis=0))) + "\n"
+    text += "每日：\n"
+    for day, row in zip(days, counts):
+        if row.sum():
+            text += f"- {day.strftime('%m-%d')}: " + "、".join(f"{t} {int(c)}" for t, c in zip(types, row) if c) + "\n"
+    return text.rstrip("\n")
+
+def prune_reports(report_dir=REPORT_DIR, max_files=REPORT_MAX_FILES, max_age_days=REPORT_MAX_AGE_DAYS):
+    """刪除超過保存天數的趨勢圖，數量仍超過上限時再從最舊的開始刪；回傳刪除數量。"""
+    entries = []
+    try:
+        names = os.listdir(report_dir)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        if name.startswith('trend_') and name.endswith('.jpg'):
+            path = os.path.join(report_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                continue
+
+    entries.sort()
+    cutoff = time.time() - max_age_days * 86400
+    remaining = len(entries)
+    removed = 0
+    for mtime, path in entries:
+        if mtime >= cutoff and remaining <= max_files:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        remaining -= 1
+    if removed:
+        logging.info(f"報表圖片清理完成：刪除 {removed} 張，剩餘 {remaining} 張")
+    return removed
+
+def render_trend_chart(days, types, counts, width=800, height=420):
+    """
+    以 OpenCV 繪製每日堆疊長條圖並存成 JPEG；內容相同時重用既有檔案。
+    每次產生新圖後依 REPORT_MAX_FILES / REPORT_MAX_AGE_DAYS 清理舊圖。回傳檔名 (位於 REPORT_DIR)。
+    """
+    digest = hashlib.sha1(repr((days[0], days[-1], types, counts.tolist())).encode()).hexdigest()[:16]
+    filename = f"trend_{digest}.jpg"
+    out_path = os.path.join(REPORT_DIR, filename)
+    if os.path.exists(out_path):
+        os.utime(out_path)  # 重用的圖片延長保存期限
+        return filename
+    os.makedirs(REPORT_DIR, exist_ok=True)
+
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    left, right, top, bottom = 50, 20, 50, 50
+    plot_w, plot_h = width - left - right, height - top - bottom
+    max_total = max(1, int(counts.sum(axis=1).max()) if len(days) else 1)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+
+    # 座標軸與 y 軸刻度
+    cv2.line(img, (left, top), (left, top + plot_h), (0, 0, 0), 1)
+    cv2.line(img, (left, top + plot_h), (left + plot_w, top + plot_h), (0, 0, 0), 1)
+    for tick in sorted({0, max_total // 2, max_total}):
+        y = top + plot_h - int(plot_h * tick / max_total)
+        cv2.line(img, (left - 4, y), (left + plot_w, y), (220, 220, 220), 1)
+        cv2.putText(img, str(tick), (5, y + 4), font, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
+
+    # 堆疊長條
+    slot = plot_w / max(1, len(days))
+    bar_w = max(2, int(slot * 0.6))
+    label_every = max(1, len(days) // 10)
+    for i, day in enumerate(days):
+        x = left + int(slot * i + (slot - bar_w) / 2)
+        y = top + plot_h
+        for j in range(len(types)):
+            h = int(plot_h * counts[i, j] / max_total)
+            if h:
+                cv2.rectangle(img, (x, y - h), (x + bar_w, y), _PALETTE[j % len(_PALETTE)], -1)
+                y -= h
+        if i % label_every == 0:
+            cv2.putText(img, day.strftime('%m/%d'), (x - 4, top + plot_h + 18), font, 0.4, (0, 0, 0), 1, cv2.LINE_AA)
+
+    # 圖例 (類型名稱為英文代碼，OpenCV 無法繪製中文)
+    x = left
+    for j, violation_type in enumerate(types):
+        color = _PALETTE[j % len(_PALETTE)]
+        cv2.rectangle(img, (x, 15), (x + 14, 29), color, -1)
+        cv2.putText(img, violation_type, (x + 20, 27), font, 0.5, (0, 0, 0), 1, cv2.LINE_AA)
+        x += 40 + 10 * len(violation_type)
+
+    cv2.imwrite(out_path, img, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    try:
+        prune_reports()
+    except OSError as e:
+        logging.warning(f"清理報表圖片失敗: {e}")
+    return filename
+
@@ -0,0 +1,186 @@
+# violation_rules.py
+# 宣告式違規規則引擎：規則只編譯一次，之後每張圖片對同一組偵測結果做向量化檢查
+import json
+import logging
+import os
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# 預設規則：no_helmet 與舊版邏輯相同；其餘規則只有在模型具備對應類別時才會啟用
+DEFAULT_RULES = [
+    {"name": "no_helmet", "type": "missing_overlap", "subject": "head", "object": "helmet", "iou": 0.1},
+    {"name": "no_vest", "type": "missing_containment", "subject": "person", "object": "vest", "containment": 0.5},
+    {"name": "no_harness", "type": "missing_containment", "subject": "person", "object": "harness", "containment": 0.5},
+]
+DEFAULT_MIN_CONF = 0.25
+
+
+# --- 向量化幾何運算 (N 個 subject 對 M 個 object 一次算完) ---
+def box_areas(boxes):
+    return np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+def _intersection_areas(a, b):
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:4], b[None, :, 2:4])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    return wh[..., 0] * wh[..., 1]
+
+def pairwise_iou(a, b):
+    """回傳 (N, M) 的 IoU 矩陣。"""
+    inter = _intersection_areas(a, b)
+    union = box_areas(a)[:, None] + box_areas(b)[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+def pairwise_containment(outer, inner):
+    """回傳 (N, M) 矩陣：inner[j] 的面積有多少比例落在 outer[i] 內。"""
+    inter = _intersection_areas(outer, inner)
+    inner_area = box_areas(inner)[None, :]
+    return np.divide(inter, inner_area, out=np.zeros_like(inter), where=inner_area > 0)
+
+def points_in_polygon(points, polygon):
+    """射線法判斷點是否落在多邊形內；只對多邊形的邊做迴圈，點的部分是向量化的。"""
+    x, y = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    x_j, y_j = polygon[-1]
+    for x_i, y_i in polygon:
+        crosses = (y_i > y) != (y_j > y)
+        if y_j != y_i:
+            x_cross = (x_j - x_i) * (y - y_i) / (y_j - y_i) + x_i
+            inside ^= crosses & (x < x_cross)
+        x_j, y_j = x_i, y_i
+    return inside
+
+
+# --- 規則編譯 ---
+class CompiledRule:
+    """單條規則編譯後的結果：類別名稱已轉成 class id，門檻與多邊形已轉成 numpy 陣列。"""
+
+    def __init__(self, name, rule_type, subject_id, object_id=None, threshold=0.0,
+                 min_conf=DEFAULT_MIN_CONF, zones=None, normalized=False):
+        self.name = name
+        self.rule_type = rule_type
+        self.subject_id = subject_id
+        self.object_id = object_id
+        self.threshold = threshold
+        self.min_conf = min_conf
+        self.zones = zones or []
+        self.normalized = normalized
+
+    def count_offenders(self, boxes_of, frame_shape):
+        """回傳違反此規則的 subject 數量；boxes_of(class_id, min_conf) 提供已切好的偵測框。"""
+        subjects = boxes_of(self.subject_id, self.min_conf)
+        if len(subjects) == 0:
+            return 0
+
+        if self.rule_type == "in_zone":
+            # 以框的底部中心 (約略為人員站立位置) 判斷是否進入禁區
+            anchors = np.stack([(subjects[:, 0] + subjects[:, 2]) / 2, subjects[:, 3]], axis=1)
+            in_any_zone = np.zeros(len(subjects), dtype=bool)
+            scale = np.array([frame_shape[1], frame_shape[0]], dtype=np.float32) if self.normalized else 1.0
+            for zone in self.zones:
+                in_any_zone |= points_in_polygon(anchors, zone * scale)
+            return int(in_any_zone.sum())
+
+        objects = boxes_of(self.object_id, self.min_conf)
+        if len(objects) == 0:
+            return len(subjects)
+        if self.rule_type == "missing_overlap":
+            scores = pairwise_iou(subjects, objects)
+        else:  # missing_containment
+            scores = pairwise_containment(subjects, objects)
+        return int((~(scores >= self.threshold).any(axis=1)).sum())
+
+
+def _lookup(names_map, class_name):
+    return names_map.get(str(class_name).lower())
+
+def compile_rule(rule, names_map):
+    """將規則 dict 編譯為 CompiledRule；模型缺少類別時回傳 None (規則停用)。"""
+    name = rule["name"]
+    rule_type = rule["type"]
+    min_conf = float(rule.get("min_conf", DEFAULT_MIN_CONF))
+    subject_id = _lookup(names_map, rule["subject"])
+    if subject_id is None:
+        logging.info(f"規則 '{name}' 停用：模型中沒有類別 '{rule['subject']}'")
+        return None
+
+    if rule_type == "in_zone":
+        zones = [np.asarray(zone, dtype=np.float32).reshape(-1, 2) for zone in rule.get("zones", [])]
+        if not zones or any(len(zone) < 3 for zone in zones):
+            raise ValueError(f"規則 '{name}' 的 zones 必須是至少三個頂點的多邊形")
+        return CompiledRule(name, rule_type, subject_id, min_conf=min_conf,
+                            zones=zones, normalized=bool(rule.get("normalized", False)))
+
+    if rule_type not in ("missing_overlap", "missing_containment"):
+        raise ValueError(f"規則 '{name}' 的類型 '{rule_type}' 不支援")
+    object_id = _lookup(names_map, rule["object"])
+    if object_id is None:
+        logging.info(f"規則 '{name}' 停用：模型中沒有類別 '{rule['object']}'")
+        return None
+    threshold_key = "iou" if rule_type == "missing_overlap" else "containment"
+    threshold = float(rule.get(threshold_key, 0.1 if rule_type == "missing_overlap" else 0.5))
+    return CompiledRule(name, rule_type, subject_id, object_id, threshold, min_conf)
+
+
+def load_rules(rules_path=None):
+    """從 JSON 檔載入規則 (VIOLATION_RULES_PATH)；未設定或讀取失敗時使用預設規則。"""
+    rules_path = rules_path or os.getenv('VIOLATION_RULES_PATH')
+    if not rules_path:
+        return DEFAULT_RULES
+    try:
+        with open(rules_path, encoding='utf-8') as f:
+            rules = json.load(f)
+        logging.info(f"已載入違規規則設定: {rules_path} ({len(rules)} 條)")
+        return rules
+    except Exception as e:
+        logging.error(f"讀取違規規則設定失敗 ({rules_path})，改用預設規則: {e}")
+        return DEFAULT_RULES
+
+
+class RuleEngine:
+    """在同一組偵測結果上評估所有規則；每個 (類別, 信心門檻) 的切片只計算一次。"""
+
+    def __init__(self, rules, names_map):
+        # names_map: {class_id: class_name}，轉成小寫名稱 -> id 方便查找
+        lookup = {str(class_name).lower(): int(class_id) for class_id, class_name in names_map.items()}
+        self.rules = []
+        for rule in rules:
+            try:
+                compiled = compile_rule(rule, lookup)
+            except (KeyError, ValueError, TypeError) as e:
+                logging.error(f"規則設定錯誤，已略過 {rule}: {e}")
+                continue
+            if compiled is not None:
+                self.rules.append(compiled)
+        # 所有規則都需要 subject 才可能違規；沒有任何 subject 的圖片可以提前結束
+        self.subject_ids = np.array(sorted({rule.subject_id for rule in self.rules}), dtype=np.int64)
+        logging.info(f"啟用的違規規則: {[rule.name for rule in self.rules]}")
+
+    def subject_detections(self, detections, min_conf=0.0):
+        """回傳屬於任一規則 subject 類別的偵測列 (例如 head / person)。"""
+        detections = np.asarray(detections, dtype=np.float32).reshape(-1, 6)
+        mask = np.isin(detections[:, 5].astype(np.int64), self.subject_ids) & (detections[:, 4] >= min_conf)
+        return detections[mask]
+
+    def evaluate(self, detections, frame_shape):
+        """detections 為 YOLO 的 (N, 6) 陣列 [x1, y1, x2, y2, conf, cls]；回傳 {規則名稱: 違規數量}。"""
+        detections = np.asarray(detections, dtype=np.float32).reshape(-1, 6)
+        boxes = detections[:, :4]
+        confs = detections[:, 4]
+        cls_ids = detections[:, 5].astype(np.int64)
+        cache = {}
+
+        def boxes_of(class_id, min_conf):
+            key = (class_id, min_conf)
+            if key not in cache:
+                cache[key] = boxes[(cls_ids == class_id) & (confs >= min_conf)]
+            return cache[key]
+
+        violations = {}
+        for rule in self.rules:
+            offenders = rule.count_offenders(boxes_of, frame_shape)
+            if offenders:
+                violations[rule.name] = offenders
+        return violations
@@ -1,76 +1,133 @@
 # yolo_detector.py (精簡版)
+import contextlib
+import hashlib
 import cv2
 import torch
 import numpy as np
 import logging
+import os
 import time
+import threading
+from violation_rules import RuleEngine, load_rules
+from runtime_profile import load_runtime_profile, apply_runtime_profile, prepare_model, inference_context
+from shadow_eval import ShadowEvaluator, SHADOW_MODEL_PATH
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def calculate_iou(box1, box2):
-    # IoU 計算邏輯不變... (保持原樣)
-    x1_inter = max(box1[0], box2[0])
-    y1_inter = max(box1[1], box2[1])
-    x2_inter = min(box1[2], box2[2])
-    y2_inter = min(box1[3], box2[3])
-    inter_area = max(0, x2_inter - x1_inter) * max(0, y2_inter - y1_inter)
-    box1_area = (box1[2] - box1[0]) * (box1[3] - box1[1])
-    box2_area = (box2[2] - box2[0]) * (box2[3] - box2[1])
-    union_area = box1_area + box2_area - inter_area
-    if union_area == 0:
-        return 0.0
-    iou = inter_area / union_area
-    return iou
+# --- 預篩設定：先用便宜的檢查擋掉無法使用或沒有人員的圖片 ---
+PRESCREEN_ENABLED = os.getenv('DETECTOR_PRESCREEN', 'true').lower() == 'true'
+PRESCREEN_SIZE = int(os.getenv('DETECTOR_PRESCREEN_SIZE', 320))          # 低解析度預篩的推論尺寸
+PRESCREEN_CONF = float(os.getenv('DETECTOR_PRESCREEN_CONF', 0.1))        # 預篩的信心門檻，刻意低於模型 conf 以免漏掉遠處小目標
+BLUR_THRESHOLD = float(os.getenv('DETECTOR_BLUR_THRESHOLD', 40.0))       # Laplacian 變異數低於此值視為模糊
+DARK_THRESHOLD = float(os.getenv('DETECTOR_DARK_THRESHOLD', 25.0))       # 平均亮度 (0-255)
+BRIGHT_THRESHOLD = float(os.getenv('DETECTOR_BRIGHT_THRESHOLD', 235.0))
+INFERENCE_SIZES = (640, 1280)                                             # 一般 / 小目標 的推論尺寸
+SMALL_OBJECT_RATIO = 0.04                                                 # 最小目標邊長 / 圖片長邊 低於此值改用大尺寸
+STATS_LOG_EVERY = 50
+
+def check_image_quality(frame):
+    """
+    在 256px 的灰階縮圖上檢查模糊與曝光，回傳問題描述；沒有問題時回傳 None。
+    只需幾毫秒，遠低於一次模型推論。
+    """
+    scale = 256 / max(frame.shape[:2])
+    small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else frame
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    brightness = float(gray.mean())
+    if brightness < DARK_THRESHOLD:
+        return "圖片過暗，請重新拍攝"
+    if brightness > BRIGHT_THRESHOLD:
+        return "圖片過曝，請重新拍攝"
+    if cv2.Laplacian(gray, cv2.CV_64F).var() < BLUR_THRESHOLD:
+        return "圖片模糊，請重新拍攝"
+    return None
+
+def choose_inference_size(frame_shape, prescreen_subjects):
+    """依圖片大小與預篩到的目標大小決定推論尺寸 (YOLOv5 需為 32 的倍數)。"""
+    long_side = max(frame_shape[:2])
+    size = INFERENCE_SIZES[0]
+    if len(prescreen_subjects):
+        widths = prescreen_subjects[:, 2] - prescreen_subjects[:, 0]
+        heights = prescreen_subjects[:, 3] - prescreen_subjects[:, 1]
+        if float(np.minimum(widths, heights).min()) / long_side < SMALL_OBJECT_RATIO:
+            size = INFERENCE_SIZES[1]
+    # 不要把小圖放大推論
+    return int(min(size, max(32, -(-long_side // 32) * 32)))
+
+def _content_key(image_path):
+    """圖片原始內容的 SHA-256，與 EvidenceStore 的 key 相同 (暫存檔名在請求結束後就被刪除)。"""
+    with open(image_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def load_yolo_model(model_path):
+    """載入 YOLOv5 自訂模型，回傳 (model, {class_id: class_name})。"""
+    model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_path, trust_repo=True)
+    names_map = {}
+    # 簡化類別 ID 查找 (假設 names 是字典或列表)
+    if hasattr(model, 'names') and model.names:
+        if isinstance(model.names, dict):
+            names_map = model.names
+        elif isinstance(model.names, (list, tuple)):
+            names_map = {i: name for i, name in enumerate(model.names)}
+        else:
+            logging.warning("無法識別的 model.names 格式")
+    else:
+        logging.warning("模型缺少 'names' 屬性或 'names' 為空。")
+    return model, names_map
 
 class SafetyViolationDetector:
-    def __init__(self, model_path="best.pt"):
+    def __init__(self, model_path="best.pt", rules=None, runtime_profile=None, shadow_model_path=SHADOW_MODEL_PATH):
         self.model = None
-        self.head_class_id = -1
-        self.helmet_class_id = -1
         self.model_names = {}
-        self.iou_threshold = 0.1 # IoU 閾值可以保留
+        self.rule_engine = None
+        rules = rules if rules is not None else load_rules()
+        self.stats = {"total": 0, "skipped_quality": 0, "skipped_no_subject": 0, "full_inference": 0,
+                      "forward_passes": 0, "forward_ms": 0.0}
+        self.base_conf = 0.25
+        self.stats_lock = threading.Lock()
+
+        # 執行緒數 / CPU 綁定需在模型載入與第一次推論前套用
+        self.runtime_profile = runtime_profile or load_runtime_profile()
+        apply_runtime_profile(self.runtime_profile)
 
         try:
             # 載入模型
-            self.model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_path, trust_repo=True)
+            self.model, self.model_names = load_yolo_model(model_path)
+            prepare_model(self.model, self.runtime_profile)
+            # 模型以預篩門檻輸出 (NMS 用)，判定違規前再濾回原本的 conf，結果與未預篩時相同
+            self.base_conf = float(getattr(self.model, 'conf', self.base_conf))
+            self.model.conf = min(self.base_conf, PRESCREEN_CONF)
             logging.info(f"YOLOv5 模型載入成功: {model_path}")
 
-            # 簡化類別 ID 查找 (假設 names 是字典或列表)
-            if hasattr(self.model, 'names') and self.model.names:
-                if isinstance(self.model.names, dict):
-                    names_map = self.model.names
-                elif isinstance(self.model.names, (list, tuple)):
-                    names_map = {i: name for i, name in enumerate(self.model.names)}
-                else:
-                    names_map = {}
-                    logging.warning("無法識別的 model.names 格式")
-
-                self.model_names = names_map # 仍然保存以備不時之需
-                for class_id, class_name in names_map.items():
-                    if isinstance(class_name, str):
-                        if class_name.lower() == 'head':
-                            self.head_class_id = int(class_id)
-                        elif class_name.lower() == 'helmet':
-                            self.helmet_class_id = int(class_id)
-
-                logging.info(f"Head class ID: {self.head_class_id}, Helmet class ID: {self.helmet_class_id}")
-                if self.head_class_id == -1 or self.helmet_class_id == -1:
-                    logging.warning("模型中未找到 'head' 或 'helmet' 類別，'no_helmet' 檢測可能無法運作。")
-            else:
-                logging.warning("模型缺少 'names' 屬性或 'names' 為空。")
+            # 規則只編譯一次，之後每張圖片共用
+            self.rule_engine = RuleEngine(rules, self.model_names)
+            if not self.rule_engine.rules:
+                logging.warning("模型類別無法對應任何違規規則，檢測可能無法運作。")
 
         except Exception as e:
             logging.error(f"初始化 YOLO 檢測器失敗: {e}", exc_info=True)
             self.model = None # 標記失敗
 
+        # 候選模型影子評估 (選用，失敗不影響主模型)
+        self.shadow = None
+        if shadow_model_path and self.model is not None:
+            try:
+                candidate, candidate_names = load_yolo_model(shadow_model_path)
+                prepare_model(candidate, self.runtime_profile)
+                self.shadow = ShadowEvaluator(candidate, candidate_names, RuleEngine(rules, candidate_names),
+                                              lambda: inference_context(self.runtime_profile), self.model_names)
+                logging.info(f"候選模型載入成功 (影子模式): {shadow_model_path}")
+            except Exception as e:
+                logging.error(f"載入候選模型失敗，影子評估停用: {e}", exc_info=True)
+
     def detect(self, image_path):
         start_time = time.time()
         if self.model is None:
              logging.error("模型未初始化，無法進行檢測。")
              # 返回符合 linebot_handler 預期格式的錯誤
              return [{"violation_detected": False, "violation_type": "模型初始化失敗", "image_saved_path": None}]
-        if self.head_class_id == -1 or self.helmet_class_id == -1:
-            logging.error("模型缺少必要類別 (head 或 helmet)，無法進行檢測。")
+        if self.rule_engine is None or not self.rule_engine.rules:
+            logging.error("模型缺少必要類別，沒有可用的違規規則，無法進行檢測。")
             return [{"violation_detected": False, "violation_type": "模型缺少必要類別", "image_saved_path": None}]
 
         try:
@@ -79,45 +136,91 @@ class SafetyViolationDetector:
                 logging.error(f"無法讀取圖片: {image_path}")
                 return [{"violation_detected": False, "violation_type": "圖片讀取失敗", "image_saved_path": None}]
 
-            # 模型偵測
-            detections = self.model(frame)
-            processed_detections = detections.xyxy[0].cpu().numpy()
-
-            detected_heads = []
-            detected_helmets = []
-
-            for det in processed_detections:
-                x_min, y_min, x_max, y_max, conf, cls_id_float = det
-                cls_id = int(cls_id_float)
-                box = [x_min, y_min, x_max, y_max]
-                if cls_id == self.head_class_id:
-                    detected_heads.append({"box": box, "conf": conf})
-                elif cls_id == self.helmet_class_id:
-                    detected_helmets.append({"box": box, "conf": conf})
-
-            # 核心檢查邏輯 (移除內部詳細 Log)
-            found_no_helmet = False
-            for head in detected_heads:
-                has_associated_helmet = False
-                for helmet in detected_helmets:
-                    iou = calculate_iou(head["box"], helmet["box"])
-                    if iou >= self.iou_threshold:
-                        has_associated_helmet = True
-                        break # 找到對應的頭盔，檢查下一個頭
-
-                if not has_associated_helmet:
-                    # 找到第一個未戴安全帽的就結束
-                    logging.info(f"偵測到 'no_helmet' 違規 in {image_path}")
-                    end_time = time.time()
-                    logging.info(f"檢測耗時: {end_time - start_time:.2f} 秒")
-                    return [{"violation_detected": True, "violation_type": "no_helmet", "image_saved_path": image_path}]
-
-            # 如果循環結束都沒找到違規
-            logging.info(f"未在圖片中偵測到 'no_helmet' 違規: {image_path}")
+            inference_size = INFERENCE_SIZES[0]
+            passes = []
+            # 影子評估在預篩之前抽樣，預篩略過的圖片也會交給候選模型比對
+            sampled = self.shadow is not None and self.shadow.sample()
+            if PRESCREEN_ENABLED:
+                # 1. 模糊 / 曝光檢查
+                quality_issue = check_image_quality(frame)
+                if quality_issue:
+                    self._record("skipped_quality")
+                    logging.info(f"預篩略過 ({quality_issue}): {image_path}")
+                    return [{"violation_detected": False, "violation_type": quality_issue, "image_saved_path": None}]
+
+                # 2. 低解析度預篩：以低門檻連一個目標都沒有 (不限類別) 時才略過完整推論
+                prescreen = self._forward(frame, PRESCREEN_SIZE, passes)
+                if len(prescreen) == 0:
+                    self._record("skipped_no_subject", passes)
+                    if sampled:
+                        # 主模型的判定來自預篩那次 forward，候選模型也以相同尺寸比對
+                        self.shadow.submit(frame, _content_key(image_path), PRESCREEN_SIZE, prescreen, {}, passes[-1])
+                    logging.info(f"預篩未發現任何目標，略過完整推論: {image_path} ({time.time() - start_time:.2f} 秒)")
+                    return [{"violation_detected": False, "violation_type": None, "image_saved_path": None}]
+                subjects = self.rule_engine.subject_detections(prescreen, PRESCREEN_CONF)
+                inference_size = choose_inference_size(frame.shape, subjects)
+
+            # 模型偵測 (單次 forward，所有規則共用同一組偵測結果)；預篩只決定略過與否，不作為判定依據
+            processed_detections = self._forward(frame, inference_size, passes)
+            self._record("full_inference", passes)
+            processed_detections = processed_detections[processed_detections[:, 4] >= self.base_conf]
+            violations = self.rule_engine.evaluate(processed_detections, frame.shape)
+            if sampled:
+                # 只做入列，候選模型在背景執行緒跑，不影響回覆
+                self.shadow.submit(frame, _content_key(image_path), inference_size,
+                                   processed_detections, violations, passes[-1])
+
             end_time = time.time()
-            logging.info(f"檢測耗時: {end_time - start_time:.2f} 秒")
+            logging.info(f"檢測耗時: {end_time - start_time:.2f} 秒 (推論尺寸 {inference_size})")
+            if violations:
+                logging.info(f"偵測到違規 {violations} in {image_path}")
+                return [{"violation_detected": True, "violation_type": violation_type, "image_saved_path": image_path}
+                        for violation_type in violations]
+
+            logging.info(f"未在圖片中偵測到違規: {image_path}")
             return [{"violation_detected": False, "violation_type": None, "image_saved_path": None}]
 
         except Exception as e:
             logging.error(f"執行檢測時發生錯誤: {e}", exc_info=True)
-            return [{"violation_detected": False, "violation_type": f"檢測時發生錯誤", "image_saved_path": None}]
\ No newline at end of file
+            return [{"violation_detected": False, "violation_type": f"檢測時發生錯誤", "image_saved_path": None}]
+
+    def _forward(self, frame, size, passes):
+        """執行一次模型推論，回傳 (N, 6) 偵測陣列；耗時 (ms) 附加到 passes。"""
+        # 啟用影子評估時標記主模型推論中，候選模型會等到沒有主模型推論時才執行
+        with self.shadow.primary_pass() if self.shadow else contextlib.nullcontext():
+            forward_start = time.perf_counter()
+            with inference_context(self.runtime_profile):
+                detections = self.model(frame, size=size).xyxy[0].cpu().numpy()
+            passes.append((time.perf_counter() - forward_start) * 1000)
+        return detections
+
+    def _record(self, outcome, passes=()):
+        # 每張圖片只會記錄一種結果：略過 (品質 / 無目標) 或 完整推論；另累計實際 forward 次數與耗時
+        with self.stats_lock:
+            self.stats["total"] += 1
+            self.stats[outcome] += 1
+            self.stats["forward_passes"] += len(passes)
+            self.stats["forward_ms"] += sum(passes)
+            total = self.stats["total"]
+        if total % STATS_LOG_EVERY == 0:
+            stats = self.get_stats()
+            logging.info(f"預篩統計: {stats['total']} 張，略過率 {stats['skip_rate']:.1%} "
+                         f"(模糊/曝光 {stats['skipped_quality']}，無目標 {stats['skipped_no_subject']})；"
+                         f"平均每張 {stats['passes_per_image']:.2f} 次 forward、"
+                         f"{stats['forward_ms_per_image']:.1f} ms (未預篩時為 1 次 640 推論)")
+
+    def get_stats(self):
+        """
+        回傳預篩統計 (總數、各類略過數與略過率) 與實際成本 (平均每張 forward 次數與推論毫秒數)，
+        啟用影子評估時一併回傳其計數。
+        """
+        with self.stats_lock:
+            stats = dict(self.stats)
+        skipped = stats["skipped_quality"] + stats["skipped_no_subject"]
+        total = stats["total"]
+        stats["skip_rate"] = skipped / total if total else 0.0
+        stats["passes_per_image"] = stats["forward_passes"] / total if total else 0.0
+        stats["forward_ms_per_image"] = stats["forward_ms"] / total if total else 0.0
+        if self.shadow:
+            stats["shadow"] = self.shadow.get_stats()
+        return stats